@@ -3,24 +3,41 @@
 __all__ = ["index", "modules", "custom_doc_links", "git_url"]
 
 index = {"PseudoData": "00_pseudodata.ipynb",
+         "TorchPseudoData": "00_pseudodata.ipynb",
          "paper_sig": "00_pseudodata.ipynb",
          "paper_bkg": "00_pseudodata.ipynb",
          "ModelWrapper": "01_model_wrapper.ipynb",
          "DataSet": "02_data.ipynb",
          "WeightedDataLoader": "02_data.ipynb",
          "DataPair": "02_data.ipynb",
+         "TensorDataSet": "02_data.ipynb",
+         "PermBatchSampler": "02_data.ipynb",
+         "BatchDataLoader": "02_data.ipynb",
+         "MemmapDataSet": "02_data.ipynb",
+         "write_pseudodata": "02_data.ipynb",
          "get_paper_data": "02_data.ipynb",
+         "PseudoDataLoader": "02_data.ipynb",
+         "get_paper_stream": "02_data.ipynb",
+         "Prefetcher": "02_data.ipynb",
          "AbsCallback": "03_callback.ipynb",
          "LossTracker": "03_callback.ipynb",
          "EarlyStopping": "03_callback.ipynb",
          "SaveBest": "03_callback.ipynb",
          "PredHandler": "03_callback.ipynb",
+         "NuisanceTransform": "03_callback.ipynb",
+         "paper_nuisances": "03_callback.ipynb",
+         "SystMod": "03_callback.ipynb",
          "PaperSystMod": "03_callback.ipynb",
          "GradClip": "03_callback.ipynb",
+         "ProfileCallback": "03_callback.ipynb",
          "to_device": "04_utils.ipynb",
          "device": "04_utils.ipynb",
          "to_np": "04_utils.ipynb",
          "init_net": "04_utils.ipynb",
+         "fingerprint": "04_utils.ipynb",
+         "PredCache": "04_utils.ipynb",
+         "set_pred_cache": "04_utils.ipynb",
+         "get_pred_cache": "04_utils.ipynb",
          "plt_style": "05_plotting.ipynb",
          "plt_sz": "05_plotting.ipynb",
          "plt_cat_pal": "05_plotting.ipynb",
@@ -30,21 +47,46 @@ index = {"PseudoData": "00_pseudodata.ipynb",
          "plt_leg_sz": "05_plotting.ipynb",
          "plot_preds": "05_plotting.ipynb",
          "plot_likelihood": "05_plotting.ipynb",
+         "histogram": "06_inference.ipynb",
          "bin_preds": "06_inference.ipynb",
          "get_shape": "06_inference.ipynb",
          "get_paper_syst_shapes": "06_inference.ipynb",
          "get_likelihood_width": "06_inference.ipynb",
+         "get_likelihood_widths": "06_inference.ipynb",
          "interp_shape": "06_inference.ipynb",
+         "calc_batch_nll": "06_inference.ipynb",
          "calc_nll": "06_inference.ipynb",
          "jacobian": "06_inference.ipynb",
+         "vmap_jacobian": "06_inference.ipynb",
          "calc_grad_hesse": "06_inference.ipynb",
+         "calc_poi_var": "06_inference.ipynb",
+         "calc_batch_grad_hesse": "06_inference.ipynb",
+         "calc_analytic_grad_hesse": "06_inference.ipynb",
+         "TemplateModel": "06_inference.ipynb",
+         "NewtonSolver": "06_inference.ipynb",
          "calc_profile": "06_inference.ipynb",
+         "MultiChannel": "06_inference.ipynb",
+         "sample_toys": "06_inference.ipynb",
+         "fit_toys": "06_inference.ipynb",
+         "run_toys": "06_inference.ipynb",
          "VariableSoftmax": "07_inferno_exact.ipynb",
          "AbsInferno": "07_inferno_exact.ipynb",
          "PaperInferno": "07_inferno_exact.ipynb",
          "InfernoPred": "07_inferno_exact.ipynb",
          "AbsApproxInferno": "08_inferno_interp.ipynb",
-         "ApproxPaperInferno": "08_inferno_interp.ipynb"}
+         "ApproxPaperInferno": "08_inferno_interp.ipynb",
+         "is_distributed": "09_distributed.ipynb",
+         "all_reduce_sum": "09_distributed.ipynb",
+         "all_reduce_grad": "09_distributed.ipynb",
+         "DistributedLoader": "09_distributed.ipynb",
+         "DistributedSync": "09_distributed.ipynb",
+         "DistributedStop": "09_distributed.ipynb",
+         "launch": "09_distributed.ipynb",
+         "fit_distributed": "09_distributed.ipynb",
+         "param_grid": "10_sweep.ipynb",
+         "SweepStore": "10_sweep.ipynb",
+         "train_paper_inferno": "10_sweep.ipynb",
+         "run_sweep": "10_sweep.ipynb"}
 
 modules = ["pseudodata.py",
            "model_wrapper.py",
@@ -53,7 +95,9 @@ modules = ["pseudodata.py",
            "utils.py",
            "plotting.py",
            "inference.py",
-           "inferno.py"]
+           "inferno.py",
+           "distributed.py",
+           "sweep.py"]
 
 doc_url = "https://GilesStrong.github.io/pytorch_inferno/"
 
@@ -1,15 +1,25 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/03_callback.ipynb (unless otherwise specified).
 
-__all__ = ['AbsCallback', 'LossTracker', 'EarlyStopping', 'SaveBest', 'PredHandler', 'PaperSystMod', 'GradClip']
+__all__ = ['AbsCallback', 'LossTracker', 'EarlyStopping', 'SaveBest', 'PredHandler', 'NuisanceTransform',
+           'paper_nuisances', 'SystMod', 'PaperSystMod', 'GradClip', 'ProfileCallback']
 
 # Cell
 from .utils import to_np
 
-from typing import Optional, Callable, Union
+from typing import Optional, Callable, Union, List, Tuple
 from fastcore.all import store_attr, Path
+from collections import defaultdict
+from functools import wraps, partial
+from time import perf_counter
 import math
+import json
+import sys
+try: import resource
+except ImportError: resource = None  # Unavailable on Windows
 import numpy as np
+import pandas as pd
 
+import torch
 from torch import Tensor
 from torch import nn
 
@@ -17,6 +27,8 @@ from torch import nn
 class AbsCallback():
     r'''Abstract callback passing though all action points and indicating where callbacks can affect the model.
     See `ModelWrapper` etc. to see where exactly these action points are called.'''
+    _fingerprint_skip = ('wrapper',)  # Attributes excluded from `fingerprint`s, e.g. of cached predictions
+
     def __init__(self): pass
 
     def set_wrapper(self, wrapper) -> None: self.wrapper = wrapper
@@ -127,23 +139,81 @@ class SaveBest(AbsCallback):
 
 # Cell
 class PredHandler(AbsCallback):
-    r'''Default callback for predictions. Collects predictions over batches and returns them as stacked array'''
-    def __init__(self): self.reset()
-    def reset(self) -> None: self.preds = []
+    r'''Default callback for predictions. Collects predictions over batches and returns them as a single array.
+    Predictions are written into `out`, if set, e.g. a preallocated array or `np.memmap`, otherwise into an array allocated on the first batch to fit the whole dataset,
+    such that predictions are not held twice. If the size of the data is unknown, per-batch predictions are instead stacked at the end.'''
+    _fingerprint_skip = ('wrapper', 'out', 'preds', 'n')
+
+    def __init__(self, out:Optional[np.ndarray]=None):
+        self.out = out
+        self.reset()
+
+    def reset(self) -> None: self.preds,self.n = [],0
     def on_pred_begin(self) -> None: self.reset()
-    def on_pred_end(self) -> None: self.preds = np.vstack(self.preds)
     def get_preds(self) -> np.ndarray: return self.preds
+
+    def set_preds(self, preds:np.ndarray) -> None:
+        r'''Set collected predictions, e.g. loaded from a cache, writing them into `out`, if set'''
+        self.reset()
+        if self.out is not None:
+            self.out[:len(preds)] = preds
+            preds = self.out if len(preds) == len(self.out) else self.out[:len(preds)]
+        self.preds,self.n = preds,len(preds)
+
+    def on_pred_end(self) -> None:
+        if isinstance(self.preds, list): self.preds = np.vstack(self.preds)
+        elif self.n < len(self.preds):   self.preds = self.preds[:self.n]
+
+    def _alloc(self, p:np.ndarray) -> None:
+        if self.out is not None: self.preds = self.out
+        elif hasattr(getattr(self.wrapper.data, 'dataset', None), '__len__'):
+            self.preds = np.empty((len(self.wrapper.data.dataset),*p.shape[1:]), dtype=p.dtype)
+
     def on_forwards_end(self) -> None:
-        if self.wrapper.state == 'test': self.preds.append(to_np(self.wrapper.y_pred))
+        if self.wrapper.state != 'test': return
+        p = to_np(self.wrapper.y_pred)
+        if self.n == 0: self._alloc(p)
+        if isinstance(self.preds, list): self.preds.append(p)
+        else:                            self.preds[self.n:self.n+len(p)] = p
+        self.n += len(p)
 
 # Cell
-class PaperSystMod(AbsCallback):
-    r'''Prediction callback for modifying input data from INFERNO paper according to specified nuisances.'''
-    def __init__(self, r:float=0, l:float=3): store_attr()
+class NuisanceTransform():
+    r'''Declarative transformation of input features by nuisance parameters, applied out-of-place to a whole batch in a single operation.
+    `shifts` and `scales` are lists of (feature, nuisance index, coefficient) tuples, and inputs are transformed as `x*(1+alpha@scale)+alpha@shift`,
+    where `scale` and `shift` are the (n_alpha, n_features) matrices of coefficients. The same transform is shared by training-time augmentation, e.g. `AbsInferno`,
+    and prediction-time variations, e.g. `SystMod`.'''
+    def __init__(self, n_features:int, n_alpha:int, shifts:Optional[List[Tuple[int,int,float]]]=None, scales:Optional[List[Tuple[int,int,float]]]=None):
+        store_attr()
+        self.shift,self.scale = torch.zeros(n_alpha, n_features),torch.zeros(n_alpha, n_features)
+        for f,i,c in ([] if shifts is None else shifts): self.shift[i,f] += c
+        for f,i,c in ([] if scales is None else scales): self.scale[i,f] += c
+
+    def __call__(self, x:Tensor, alpha:Union[Tensor,List[float]], mask:Optional[Tensor]=None) -> Tensor:
+        r'''Return transformed copy of `x`, shape (n_events, n_features), for nuisances `alpha`, shape (n_alpha).
+        `alpha` can also be a batch of settings, shape (n_settings, n_alpha), in which case the result has shape (n_settings, n_events, n_features).
+        If `mask` is set, only the events it selects are transformed. Derivatives w.r.t. `alpha` are kept.'''
+        if not isinstance(alpha, Tensor): alpha = torch.tensor(alpha, dtype=x.dtype, device=x.device)
+        scale,shift = 1+(alpha@self.scale.to(alpha)),alpha@self.shift.to(alpha)
+        if alpha.dim() > 1: scale,shift = scale[:,None],shift[:,None]
+        if mask is not None: scale,shift = torch.where(mask[:,None], scale, torch.ones_like(scale)),torch.where(mask[:,None], shift, torch.zeros_like(shift))
+        return x*scale.to(x.dtype)+shift.to(x.dtype)
 
-    def on_batch_begin(self) -> None:
-        self.wrapper.x[:,0] += self.r
-        self.wrapper.x[:,2] *= self.l/3
+def paper_nuisances(r_idx:Optional[int]=0, l_idx:Optional[int]=1, n_alpha:int=2, l_init:float=3) -> NuisanceTransform:
+    r'''Nuisances of the INFERNO paper problem: shift of feature 0 by nuisance `r_idx`, and scaling of feature 2 by (`l_init`+nuisance `l_idx`)/`l_init`'''
+    return NuisanceTransform(n_features=3, n_alpha=n_alpha, shifts=None if r_idx is None else [(0,r_idx,1)], scales=None if l_idx is None else [(2,l_idx,1/l_init)])
+
+# Cell
+class SystMod(AbsCallback):
+    r'''Prediction callback for transforming inputs by `transform` at nuisance values `alpha`, without modifying the data'''
+    def __init__(self, transform:NuisanceTransform, alpha:List[float]): store_attr()
+    def on_batch_begin(self) -> None: self.wrapper.x = self.transform(self.wrapper.x, self.alpha)
+
+class PaperSystMod(SystMod):
+    r'''Prediction callback for modifying input data from INFERNO paper according to specified nuisances.'''
+    def __init__(self, r:float=0, l:float=3):
+        super().__init__(paper_nuisances(), alpha=[r, l-3])
+        self.r,self.l = r,l
 
 # Cell
 class GradClip(AbsCallback):
@@ -153,4 +223,120 @@ class GradClip(AbsCallback):
         self.func = nn.utils.clip_grad_norm_ if clip_norm else nn.utils.clip_grad_value_
 
     def on_backwards_end(self) -> None:
-        if self.clip > 0: self.func(self.wrapper.model.parameters(), self.clip)
\ No newline at end of file
+        if self.clip > 0: self.func(self.wrapper.model.parameters(), self.clip)
+
+# Cell
+class ProfileCallback(AbsCallback):
+    r'''Records the wall time and peak memory of each phase of training and validation batches:
+    waiting for data, forwards pass, loss (`on_forwards_end` of other callbacks, e.g. INFERNO), backwards pass, and optimiser step.
+    Time spent in `get_inv_ikk` and the number of calls to `autograd.grad` during the loss phase are also recorded separately.
+    Should be the first callback passed to `ModelWrapper.fit`: the methods of the following callbacks, and `autograd.grad`, are only wrapped while
+    their `on_forwards_end` run, and their originals are reinstated afterwards, even if an exception is raised.
+    Peak memory is the memory allocated on CUDA devices, reset every phase, or otherwise the peak resident set size of the process via `resource`,
+    which is never reset, i.e. is the peak up to the end of the phase, and is unavailable on Windows.
+    `get_summary` returns a table of the phases and if `savename` is set, a Chrome trace (viewable in chrome://tracing or Perfetto)
+    of the first `max_events` events is written at the end of training.
+    N.B. computation on CUDA devices is asynchronous, so time is attributed to the phase in which the device is next synchronised.'''
+    def __init__(self, savename:Optional[Union[str,Path]]=None, max_events:int=1000000): store_attr()
+
+    def on_train_begin(self) -> None:
+        self.stats,self.events,self.n_grad_calls = defaultdict(lambda: [0,0.,math.nan]),[],0  # Count, time, peak memory
+        self.cuda = torch.device(self.wrapper.device).type == 'cuda'
+        self.t0,self.phase,self.patched = perf_counter(),None,[]
+
+    def on_train_end(self) -> None:
+        if self.savename is not None:
+            with open(self.savename, 'w') as fout: json.dump({'traceEvents':self.events, 'displayTimeUnit':'ms'}, fout)
+
+    def _instrument(self) -> None:
+        r'''Wraps `on_forwards_end` and `get_inv_ikk` of the following callbacks, and `autograd.grad`, in timers and counters,
+        until the last of the callbacks returns or any raises an exception'''
+        def _time_fwd_end(f:Callable[[],None], last:bool) -> Callable[[],None]:
+            def _f() -> None:
+                ok = False
+                try:
+                    f()
+                    ok = True
+                finally:
+                    self.loss_end = perf_counter()
+                    if last or not ok: self._restore()
+            return _f
+
+        def _time_ikk(f:Callable[...,Tensor]) -> Callable[...,Tensor]:
+            def _f(*args, **kargs) -> Tensor:
+                start = perf_counter()
+                r = f(*args, **kargs)
+                self._record('get_inv_ikk', start, perf_counter())
+                return r
+            return _f
+
+        cbs = self.wrapper.cbs[self.wrapper.cbs.index(self)+1:]
+        if len(cbs) == 0: return
+        for i,c in enumerate(cbs):
+            for a,w in [('on_forwards_end', partial(_time_fwd_end, last=i == len(cbs)-1)), ('get_inv_ikk', _time_ikk)]:
+                if not hasattr(c, a): continue
+                self.patched.append((c, a, a in vars(c), vars(c).get(a)))  # Instance attributes, if any, to reinstate
+                setattr(c, a, w(getattr(c, a)))
+        self.grad = torch.autograd.grad
+        @wraps(self.grad)
+        def _grad(*args, **kargs):
+            self.n_grad_calls += 1
+            return self.grad(*args, **kargs)
+        torch.autograd.grad = _grad
+
+    def _restore(self) -> None:
+        if len(self.patched) == 0: return
+        for c,a,had,o in reversed(self.patched):
+            if had: setattr(c, a, o)
+            else:   delattr(c, a)
+        self.patched = []
+        torch.autograd.grad = self.grad
+
+    def _peak_memory(self) -> float:
+        if self.cuda: return torch.cuda.max_memory_allocated(self.wrapper.device)/2**20
+        if resource is None: return math.nan
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/(2**20 if sys.platform == 'darwin' else 2**10)  # Bytes on macOS, else KiB
+
+    def _record(self, name:str, start:float, end:float) -> None:
+        mem = self._peak_memory() if name != 'get_inv_ikk' else math.nan
+        s = self.stats[(self.wrapper.state,name)]
+        s[0] += 1
+        s[1] += end-start
+        s[2] = np.fmax(s[2], mem)
+        if self.savename is not None and len(self.events) < self.max_events:
+            self.events.append({'name':name, 'cat':self.wrapper.state, 'ph':'X', 'pid':0, 'tid':0,
+                                'ts':1e6*(start-self.t0), 'dur':1e6*(end-start), 'args':{'peak_memory_mb':mem}})
+
+    def _switch(self, phase:Optional[str]) -> None:
+        r'''Ends the current phase and begins the next. Loss phases end once the last wrapped callback returns, and the time until now is data loading.'''
+        now = perf_counter()
+        if self.phase == 'loss' and phase != 'backward':
+            self._record('loss', self.start, self.loss_end)
+            self._record('data', self.loss_end, now)
+        elif self.phase is not None:
+            self._record(self.phase, self.start, now)
+        if self.cuda: torch.cuda.reset_peak_memory_stats(self.wrapper.device)
+        self.phase,self.start,self.loss_end = phase,now,now
+
+    def on_epoch_begin(self) -> None:     self._switch('data')
+    def on_epoch_end(self) -> None:       self._switch(None)
+    def on_batch_begin(self) -> None:     self._switch('forward')
+    def on_forwards_end(self) -> None:
+        self._switch('loss')
+        self._instrument()
+    def on_backwards_begin(self) -> None: self._switch('backward')
+    def on_backwards_end(self) -> None:   self._switch('step')
+    def on_batch_end(self) -> None:       self._switch('data')
+
+    def get_summary(self) -> pd.DataFrame:
+        r'''Returns a table of the number of calls, total and mean time, fraction of the time per state, and peak memory usage of each phase'''
+        df = pd.DataFrame([{'state':k[0], 'phase':k[1], 'calls':v[0], 'total_s':v[1], 'mean_ms':1e3*v[1]/v[0], 'peak_memory_mb':v[2]}
+                           for k,v in self.stats.items()])
+        tot = df[df.phase != 'get_inv_ikk'].groupby('state').total_s.sum()  # get_inv_ikk is included in loss
+        df['fraction'] = df.total_s/df.state.map(tot)
+        return df.set_index(['state','phase'])
+
+    def print_summary(self) -> None:
+        r'''Prints the summary table and the number of calls to `autograd.grad`'''
+        print(self.get_summary().to_string(float_format='{:.4g}'.format))
+        print(f'autograd.grad calls: {self.n_grad_calls}')
\ No newline at end of file
@@ -1,17 +1,22 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/02_data.ipynb (unless otherwise specified).
 
-__all__ = ['DataSet', 'WeightedDataLoader', 'DataPair', 'get_paper_data']
+__all__ = ['DataSet', 'WeightedDataLoader', 'DataPair', 'TensorDataSet', 'PermBatchSampler', 'BatchDataLoader',
+           'MemmapDataSet', 'write_pseudodata', 'get_paper_data', 'PseudoDataLoader', 'get_paper_stream', 'Prefetcher']
 
 # Cell
-from .pseudodata import paper_sig, paper_bkg, PseudoData
+from .pseudodata import paper_sig, paper_bkg, PseudoData, TorchPseudoData
+from .utils import device
 
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Sampler
 import torch
 from torch import Tensor
 
-from typing import Tuple, Union, Optional
-from fastcore.all import store_attr, delegates
+from typing import Tuple, Union, Optional, Iterator, List, Iterable, Any
+from fastcore.all import store_attr, delegates, is_listy, Path
 import numpy as np
+import math
+import queue
+import threading
 
 # Cell
 class DataSet():
@@ -49,24 +54,195 @@ class DataPair():
     def val_ds(self): return self.val_dl.dataset
 
 # Cell
-def get_paper_data(n:int, bs=2000, n_test:int=0) -> Union[DataPair,Tuple[DataPair,WeightedDataLoader]]:
-    r'''Function returning training, validation and testing data according to pseudodata used in INFERNO paper'''
-    n,n_test = n//2,n_test//2
-    sig_trn = PseudoData(paper_sig, 1).sample(n)
-    bkg_trn = PseudoData(paper_bkg, 0).sample(n)
-    sig_val = PseudoData(paper_sig, 1).sample(n)
-    bkg_val = PseudoData(paper_bkg, 0).sample(n)
+class TensorDataSet(DataSet):
+    r'''Class holding input, target and weight data as tensors, which are indexable by batches of indeces.
+    Float32 arrays are shared with the tensors, rather than copied.'''
+    def __init__(self, x:Union[np.ndarray,Tensor], y:Optional[Union[np.ndarray,Tensor]]=None, w:Optional[Union[np.ndarray,Tensor]]=None):
+        x,y,w = [torch.as_tensor(a, dtype=torch.float32) if a is not None else None for a in (x,y,w)]
+        store_attr()
+
+    def __getitem__(self, i:Union[int,Tensor]) -> Tuple[Tensor,Optional[Tensor],Optional[Tensor]]:
+        return (self.x[i],
+                self.y[i] if self.y is not None else None,
+                self.w[i] if self.w is not None else None)
+
+# Cell
+class PermBatchSampler(Sampler):
+    r'''Sampler yielding batches of indeces as slices of a (shuffled) permutation.
+    If `block_size` is set, shuffling only permutes the order of contiguous blocks of `block_size` indeces and the indeces within each block,
+    such that batches can be read from large contiguous slices of on-disk data.'''
+    def __init__(self, n:int, bs:int, shuffle:bool=False, drop_last:bool=False, block_size:Optional[int]=None):
+        store_attr('n,bs,shuffle,drop_last,block_size')  # Sampler has empty __slots__
+
+    def __len__(self) -> int: return self.n//self.bs if self.drop_last else math.ceil(self.n/self.bs)
+
+    def _get_idxs(self) -> Tensor:
+        if not self.shuffle: return torch.arange(self.n)
+        if self.block_size is None: return torch.randperm(self.n)
+        n_full = self.n//self.block_size
+        blocks = torch.randperm(n_full).tolist()+([n_full] if self.n%self.block_size else [])  # Partial block last to keep batches aligned to blocks
+        return torch.cat([(b*self.block_size)+torch.randperm(min(self.block_size, self.n-(b*self.block_size))) for b in blocks])
+
+    def __iter__(self) -> Iterator[Tensor]:
+        idxs = self._get_idxs()
+        for i in range(len(self)): yield idxs[i*self.bs:(i+1)*self.bs]
+
+# Cell
+class BatchDataLoader(WeightedDataLoader):
+    r'''`WeightedDataLoader` which loads whole batches from a `TensorDataSet` via a single indexing operation, rather than loading and collating individual samples.
+    Datasets with a `block_size` attribute, e.g. `MemmapDataSet`, are shuffled block-wise.'''
+    @delegates(DataLoader, but=['collate_fn', 'sampler', 'batch_sampler'])
+    def __init__(self, dataset:DataSet, batch_size:int=1, shuffle:bool=False, drop_last:bool=False, **kwargs):
+        sampler = PermBatchSampler(len(dataset), batch_size, shuffle=shuffle, drop_last=drop_last, block_size=getattr(dataset, 'block_size', None))
+        DataLoader.__init__(self, dataset, batch_size=None, sampler=sampler, collate_fn=self.collate_fn, **kwargs)
 
-    trn = (np.vstack((sig_trn[0],bkg_trn[0])),np.vstack((sig_trn[1],bkg_trn[1])))
-    val = (np.vstack((sig_val[0],bkg_val[0])),np.vstack((sig_val[1],bkg_val[1])))
+    @staticmethod
+    def collate_fn(b:Tuple[Tensor,Optional[Tensor],Optional[Tensor]]) -> Tuple[Tensor,Optional[Tensor],Optional[Tensor]]: return b
+
+# Cell
+class MemmapDataSet(DataSet):
+    r'''Class holding input, target and weight data in `x.npy`, and optionally `y.npy` and `w.npy`, files in `path`, which are memory-mapped rather than loaded.
+    Indexing by batches of indeces reads and caches the contiguous block of `block_size` rows containing them.'''
+    def __init__(self, path:Union[str,Path], block_size:int=100000):
+        path = Path(path)
+        x,y,w = [np.load(path/f'{n}.npy', mmap_mode='r') if (path/f'{n}.npy').exists() else None for n in 'xyw']
+        store_attr('x,y,w,block_size')
+        self.blk_start,self.blk = None,None
+
+    def _read(self, i:Union[int,Tensor]) -> List[Optional[np.ndarray]]:
+        if isinstance(i, int): return [np.array(a[i]) if a is not None else None for a in (self.x,self.y,self.w)]
+        i = i.numpy()
+        start = (i.min()//self.block_size)*self.block_size
+        if i.max() >= start+self.block_size: return [a[i] if a is not None else None for a in (self.x,self.y,self.w)]  # Batch spans blocks
+        if self.blk_start != start:
+            self.blk_start = start
+            self.blk = [np.array(a[start:start+self.block_size]) if a is not None else None for a in (self.x,self.y,self.w)]
+        return [b[i-start] if b is not None else None for b in self.blk]
+
+    def __getitem__(self, i:Union[int,Tensor]) -> Tuple[Tensor,Optional[Tensor],Optional[Tensor]]:
+        return tuple(torch.as_tensor(a, dtype=torch.float32) if a is not None else None for a in self._read(i))
+
+# Cell
+def write_pseudodata(savedir:Union[str,Path], pseudodata:Union[PseudoData,List[PseudoData]], n:int, chunk_size:int=100000) -> None:
+    r'''Sample `n` events from each of `pseudodata` and stream them to `.npy` files in `savedir` in chunks of `chunk_size` events per `PseudoData`, to be loaded by `MemmapDataSet`.
+    Each chunk is shuffled, so that blocks of the files contain a mixture of all the `pseudodata`.'''
+    if not is_listy(pseudodata): pseudodata = [pseudodata]
+    savedir = Path(savedir)
+    savedir.mkdir(exist_ok=True, parents=True)
+    n_pd,files = len(pseudodata),None
+    for start in range(0, n, chunk_size):
+        m = min(chunk_size, n-start)
+        perm = np.random.permutation(m*n_pd)
+        d = [np.vstack(a)[perm] if a[0] is not None else None for a in zip(*[p.sample(m) for p in pseudodata])]
+        if files is None:
+            files = [np.lib.format.open_memmap(savedir/f'{k}.npy', mode='w+', dtype=a.dtype, shape=(n*n_pd,*a.shape[1:])) if a is not None else None
+                     for k,a in zip('xyw', d)]
+            for k,f in zip('xyw', files):  # Remove outdated files
+                if f is None and (savedir/f'{k}.npy').exists(): (savedir/f'{k}.npy').unlink()
+        for f,a in zip(files, d):
+            if f is not None: f[start*n_pd:(start+m)*n_pd] = a
+    for f in files:
+        if f is not None: f.flush()
+
+# Cell
+def get_paper_data(n:int, bs=2000, n_test:int=0, tensor_data:bool=False,
+                   savedir:Optional[Union[str,Path]]=None) -> Union[DataPair,Tuple[DataPair,WeightedDataLoader]]:
+    r'''Function returning training, validation and testing data according to pseudodata used in INFERNO paper.
+    If `tensor_data` is true, data are held in `TensorDataSet`s and loaded in batches via `BatchDataLoader`s.
+    If `savedir` is set, data are instead streamed to disk in subdirectories of `savedir` and memory-mapped via `MemmapDataSet`s.'''
+    def _get_ds(name:str, n:int) -> DataSet:
+        if savedir is not None:
+            write_pseudodata(Path(savedir)/name, [PseudoData(paper_sig, 1),PseudoData(paper_bkg, 0)], n)
+            return MemmapDataSet(Path(savedir)/name)
+        sig,bkg = PseudoData(paper_sig, 1).sample(n),PseudoData(paper_bkg, 0).sample(n)
+        return (TensorDataSet if tensor_data else DataSet)(np.vstack((sig[0],bkg[0])),np.vstack((sig[1],bkg[1])))
 
-    trn_dl = WeightedDataLoader(DataSet(*trn), batch_size=bs, shuffle=True, drop_last=True)
-    val_dl = WeightedDataLoader(DataSet(*val), batch_size=2*bs, shuffle=True)
+    dl = BatchDataLoader if tensor_data or savedir is not None else WeightedDataLoader
+    n,n_test = n//2,n_test//2
+    trn_dl = dl(_get_ds('trn', n), batch_size=bs, shuffle=True, drop_last=True)
+    val_dl = dl(_get_ds('val', n), batch_size=2*bs, shuffle=True)
     data = DataPair(trn_dl, val_dl)
     if n_test <= 0: return data
 
-    sig_tst = PseudoData(paper_sig, 1).sample(n_test)
-    bkg_tst = PseudoData(paper_bkg, 0).sample(n_test)
-    tst = (np.vstack((sig_tst[0],bkg_tst[0])),np.vstack((sig_tst[1],bkg_tst[1])))
-    tst_dl = WeightedDataLoader(DataSet(*tst), batch_size=2*bs)
-    return data, tst_dl
\ No newline at end of file
+    tst_dl = dl(_get_ds('tst', n_test), batch_size=2*bs)
+    return data, tst_dl
+
+# Cell
+class PseudoDataLoader():
+    r'''Iterable of batches sampled on the fly from `pseudodata`, for use in place of `WeightedDataLoader`s in `DataPair`s.
+    Each iteration yields `n_batches` batches of `bs` events, split equally between the `pseudodata`, using a generator seeded with `seed`.
+    If `fixed` is true, the generator is reseeded at the start of each iteration, so the same batches are yielded every epoch, e.g. for validation;
+    otherwise every epoch uses fresh samples.'''
+    def __init__(self, pseudodata:List[TorchPseudoData], bs:int, n_batches:int, seed:Optional[int]=None, fixed:bool=False):
+        store_attr()
+        self.generator = torch.Generator(pseudodata[0].device)
+        self.init_seed = self.generator.seed() if seed is None else self.generator.manual_seed(seed).initial_seed()
+
+    def __len__(self) -> int: return self.n_batches
+
+    def __iter__(self) -> Iterator[Tuple[Tensor,Tensor,None]]:
+        if self.fixed: self.generator.manual_seed(self.init_seed)
+        for _ in range(self.n_batches):
+            x,y,_ = zip(*[p.sample(self.bs//len(self.pseudodata), generator=self.generator) for p in self.pseudodata])
+            yield torch.cat(x),torch.cat(y),None
+
+# Cell
+def get_paper_stream(n:int, bs:int=2000, device:torch.device=device, seed:Optional[int]=None) -> DataPair:
+    r'''Function returning training and validation data sampled on `device` according to pseudodata used in INFERNO paper.
+    Every training epoch uses `n` fresh events, whereas validation uses the same `n` events every epoch.'''
+    pseudodata = [TorchPseudoData(paper_sig.sample_torch, 1, device=device),TorchPseudoData(paper_bkg.sample_torch, 0, device=device)]
+    return DataPair(PseudoDataLoader(pseudodata, bs=bs, n_batches=n//bs, seed=seed),
+                    PseudoDataLoader(pseudodata, bs=2*bs, n_batches=max(1,n//(2*bs)), seed=seed+1 if seed is not None else None, fixed=True))
+
+# Cell
+class Prefetcher():
+    r'''Wraps a data loader to prepare batches ahead of their use.
+    If `thread` is true, batches are loaded (and pinned, for CUDA devices) in a background thread, up to `n_prefetch` batches ahead.
+    For CUDA devices, batches are also copied to `device` asynchronously one batch ahead; on CPU, only the loading is overlapped with computation.'''
+    def __init__(self, dl:Iterable, device:torch.device=device, thread:bool=True, n_prefetch:int=2):
+        store_attr()
+        self.cuda = torch.device(device).type == 'cuda'
+
+    def __len__(self) -> int: return len(self.dl)
+
+    @property
+    def dataset(self) -> Optional[DataSet]: return getattr(self.dl, 'dataset', None)
+
+    def _pin(self, b:Tuple[Optional[Tensor],...]) -> Tuple[Optional[Tensor],...]:
+        if not self.cuda: return b
+        return tuple(x.pin_memory() if x is not None and x.device.type == 'cpu' else x for x in b)
+
+    def _load(self) -> Iterator[Tuple[Optional[Tensor],...]]:
+        if not self.thread:
+            for b in self.dl: yield self._pin(b)
+            return
+        q,stop,end = queue.Queue(self.n_prefetch),threading.Event(),object()
+        def _put(x:Any) -> None:
+            while not stop.is_set():
+                try: return q.put(x, timeout=0.1)
+                except queue.Full: pass
+
+        def _worker() -> None:
+            try:
+                for b in self.dl:
+                    if stop.is_set(): return
+                    _put(self._pin(b))
+            except Exception as e: _put(e)
+            _put(end)
+
+        threading.Thread(target=_worker, daemon=True).start()
+        try:
+            while True:
+                b = q.get()
+                if b is end: return
+                if isinstance(b, Exception): raise b
+                yield b
+        finally: stop.set()
+
+    def __iter__(self) -> Iterator[Tuple[Optional[Tensor],...]]:
+        nxt = None
+        for b in self._load():
+            if self.cuda: b = tuple(x.to(self.device, non_blocking=True) if x is not None else x for x in b)
+            if nxt is not None: yield nxt
+            nxt = b
+        if nxt is not None: yield nxt
\ No newline at end of file
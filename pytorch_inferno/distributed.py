@@ -0,0 +1,153 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/09_distributed.ipynb (unless otherwise specified).
+
+__all__ = ['is_distributed', 'all_reduce_sum', 'all_reduce_grad', 'DistributedLoader', 'DistributedSync',
+           'DistributedStop', 'launch', 'fit_distributed']
+
+# Cell
+from .model_wrapper import ModelWrapper
+from .data import DataPair
+from .callback import AbsCallback
+
+from typing import Optional, Callable, Union, List, Any, Iterable, Tuple
+from fastcore.all import store_attr, is_listy
+import os
+import pickle
+import socket
+import tempfile
+from pathlib import Path
+from copy import deepcopy
+
+import torch
+from torch import Tensor
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+# Cell
+def is_distributed() -> bool:
+    r'''Whether a distributed process group is initialised'''
+    return dist.is_available() and dist.is_initialized()
+
+class _AllReduceSum(torch.autograd.Function):
+    r'''Sum local contributions over processes. Gradients flow to the local contributions, scaled by the number of processes.'''
+    @staticmethod
+    def forward(ctx, x:Tensor) -> Tensor:
+        x = x.clone()
+        dist.all_reduce(x)
+        return x
+
+    @staticmethod
+    def backward(ctx, grad:Tensor) -> Tensor: return dist.get_world_size()*_AllReduceGrad.apply(grad)
+
+class _AllReduceGrad(torch.autograd.Function):
+    r'''Identity on a tensor common to all processes, whose gradients from local computations are summed over processes and divided by the number of processes'''
+    @staticmethod
+    def forward(ctx, x:Tensor) -> Tensor: return x.view_as(x)
+
+    @staticmethod
+    def backward(ctx, grad:Tensor) -> Tensor: return _AllReduceSum.apply(grad)/dist.get_world_size()
+
+def all_reduce_sum(x:Tensor) -> Tensor:
+    r'''Sum `x` over all processes, if distributed. Gradients flow to the local contribution, scaled by the number of processes,
+    such that averaging gradients of parameters over processes gives the gradient of the sum.'''
+    if not is_distributed(): return x
+    return _AllReduceSum.apply(x)
+
+def all_reduce_grad(x:Tensor) -> Tensor:
+    r'''Use `x`, common to all processes, e.g. nuisance parameters, in computations on the local data, if distributed.
+    Gradients w.r.t. `x` of tensors summed via `all_reduce_sum` then include the contributions of all processes, rather than only the local one.
+    Both operations are differentiable to all orders, e.g. for hessians w.r.t. nuisances, but cannot be vectorised via `torch.func.vmap`, i.e. `hesse_method='vmap'`.'''
+    if not is_distributed(): return x
+    return _AllReduceGrad.apply(x)
+
+# Cell
+class DistributedLoader():
+    r'''Wraps a data loader such that each process receives an equal slice of every batch. Loaders on all processes must yield the same batches,
+    e.g. by seeding all processes identically.'''
+    def __init__(self, dl:Iterable, rank:Optional[int]=None, world_size:Optional[int]=None):
+        self.dl = dl
+        self.rank = dist.get_rank() if rank is None else rank
+        self.world_size = dist.get_world_size() if world_size is None else world_size
+
+    @property
+    def dataset(self): return self.dl.dataset
+    def __len__(self) -> int: return len(self.dl)
+
+    def __iter__(self) -> Iterable[List[Optional[Tensor]]]:
+        for b in self.dl: yield [t.tensor_split(self.world_size)[self.rank] if t is not None else t for t in b]
+
+# Cell
+class DistributedSync(AbsCallback):
+    r'''Training callback keeping models on all processes in sync: parameters are broadcast from rank 0 at the start of training,
+    and gradients are averaged over processes after every backwards pass. Should be the first callback.'''
+    def on_train_begin(self) -> None:
+        for p in self.wrapper.model.parameters(): dist.broadcast(p.data, 0)
+
+    def on_backwards_end(self) -> None:
+        ps = list(self.wrapper.model.parameters())
+        for p in ps:
+            if p.grad is None: p.grad = torch.zeros_like(p)
+        g = torch.cat([p.grad.flatten() for p in ps])
+        dist.all_reduce(g)
+        g /= dist.get_world_size()
+        for p,v in zip(ps, g.split([p.numel() for p in ps])): p.grad.copy_(v.view_as(p))
+
+class DistributedStop(AbsCallback):
+    r'''Training callback propagating decisions of callbacks on rank 0 to all processes: whether to stop training, broadcast at the end of each validation epoch,
+    and the final parameters, e.g. as reloaded by `SaveBest`. Should be the last callback.'''
+    def on_epoch_end(self) -> None:
+        if self.wrapper.state != 'valid': return
+        stop = torch.tensor([float(self.wrapper.stop)])
+        dist.broadcast(stop, 0)
+        self.wrapper.stop = bool(stop.item())
+
+    def on_train_end(self) -> None:
+        for p in self.wrapper.model.parameters(): dist.broadcast(p.data, 0)
+
+# Cell
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def _launch_worker(rank:int, fn:Callable[...,Any], world_size:int, port:int, seed:int, backend:str, savename:str, args:Tuple, kwargs:dict) -> None:
+    os.environ['MASTER_ADDR'],os.environ['MASTER_PORT'] = '127.0.0.1',str(port)
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    try:
+        torch.manual_seed(seed)
+        res = fn(*args, **kwargs)
+        if rank == 0:
+            with open(savename, 'wb') as fout: pickle.dump(res, fout)
+    finally:
+        dist.destroy_process_group()
+
+def launch(fn:Callable[...,Any], n_procs:int, *args, seed:int=0, backend:str='gloo', port:Optional[int]=None, **kwargs) -> Any:
+    r'''Run `fn(*args, **kwargs)` in `n_procs` local processes, each with an initialised process group and the same `seed`, returning the result of rank 0.
+    `fn`, its arguments, and its result must be picklable, so `fn` should be importable, rather than defined in a notebook.'''
+    if port is None: port = _free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        savename = str(Path(tmp)/'result.pkl')
+        mp.spawn(_launch_worker, args=(fn, n_procs, port, seed, backend, savename, args, kwargs), nprocs=n_procs, join=True)
+        with open(savename, 'rb') as fin: return pickle.load(fin)
+
+# Cell
+def _fit_worker(model:ModelWrapper, n_epochs:int, data:DataPair, opt:Callable, loss:Optional[Callable[[Tensor,Tensor],Tensor]],
+                cbs:List[AbsCallback], rank0_cbs:List[AbsCallback]) -> Tuple[dict,List[AbsCallback]]:
+    model = deepcopy(model)  # Tensors are received in shared memory, so each process needs its own copy of the parameters
+    data = DataPair(DistributedLoader(data.trn_dl), DistributedLoader(data.val_dl))
+    if dist.get_rank() != 0: rank0_cbs = []
+    model.fit(n_epochs, data=data, opt=opt, loss=loss, cbs=[DistributedSync()]+cbs+rank0_cbs+[DistributedStop()])
+    for c in rank0_cbs: del c.wrapper  # Wrapper is not returned
+    return model.model.state_dict(),rank0_cbs
+
+def fit_distributed(model:ModelWrapper, n_procs:int, n_epochs:int, data:DataPair, opt:Callable, loss:Optional[Callable[[Tensor,Tensor],Tensor]],
+                    cbs:Optional[Union[AbsCallback,List[AbsCallback]]]=None, rank0_cbs:Optional[Union[AbsCallback,List[AbsCallback]]]=None,
+                    seed:int=0, backend:str='gloo') -> List[AbsCallback]:
+    r'''Train `model` as per `ModelWrapper.fit`, but over `n_procs` local processes, each processing an equal slice of every batch.
+    Callbacks in `cbs` run on every process, e.g. INFERNO losses, which sum their shapes over processes. Callbacks in `rank0_cbs` run only on rank 0,
+    e.g. `LossTracker`, `EarlyStopping`, and `SaveBest`. All processes are seeded with `seed`, so that data are shuffled identically.
+    The trained parameters are loaded into `model` and the rank-0 callbacks are returned after training.'''
+    cbs = [] if cbs is None else list(cbs) if is_listy(cbs) else [cbs]
+    rank0_cbs = [] if rank0_cbs is None else list(rank0_cbs) if is_listy(rank0_cbs) else [rank0_cbs]
+    state,rank0_cbs = launch(_fit_worker, n_procs, model, n_epochs, data, opt, loss, cbs, rank0_cbs, seed=seed, backend=backend)
+    model.model.load_state_dict(state)
+    return rank0_cbs
\ No newline at end of file
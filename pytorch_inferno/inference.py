@@ -1,11 +1,14 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/06_inference.ipynb (unless otherwise specified).
 
-__all__ = ['bin_preds', 'get_shape', 'get_paper_syst_shapes', 'get_likelihood_width', 'interp_shape', 'calc_nll',
-           'jacobian', 'calc_grad_hesse', 'calc_profile']
+__all__ = ['histogram', 'bin_preds', 'get_shape', 'get_paper_syst_shapes', 'get_likelihood_width',
+           'get_likelihood_widths', 'interp_shape', 'calc_batch_nll', 'calc_nll', 'jacobian', 'vmap_jacobian',
+           'calc_grad_hesse', 'calc_poi_var', 'calc_batch_grad_hesse', 'calc_analytic_grad_hesse', 'TemplateModel',
+           'NewtonSolver', 'calc_profile', 'MultiChannel', 'sample_toys', 'fit_toys', 'run_toys']
 
 # Cell
 from .model_wrapper import ModelWrapper
-from .callback import PaperSystMod, PredHandler
+from .callback import PaperSystMod, PredHandler, paper_nuisances
+from .utils import to_np, fingerprint, PredCache, get_pred_cache
 
 import pandas as pd
 import numpy as np
@@ -13,59 +16,164 @@ from typing import *
 from collections import OrderedDict
 from scipy.interpolate import InterpolatedUnivariateSpline
 import itertools
-from fastcore.all import partialler
+import inspect
+from fastcore.all import partialler, store_attr
 from fastprogress import progress_bar
 import math
+from concurrent.futures import ProcessPoolExecutor
 
 from torch import Tensor, autograd
 import torch
-from torch.distributions import Distribution
+from torch.distributions import Distribution, Normal
+
+# Cell
+def _preds_to_bins(preds:Tensor, bins:Tensor) -> Tensor:
+    r'''Default mapping of model outputs to bin indeces: hard assignment via argmax for multi-class outputs, otherwise binning of single outputs according to `bins`'''
+    if preds.shape[-1] > 1: return preds.argmax(-1)
+    return torch.bucketize(preds.squeeze(-1), bins.to(preds.dtype), right=True)-1  # As per `bin_preds`
+
+def histogram(preds:Tensor, mode:str='soft', w:Optional[Tensor]=None, bins:Optional[Union[Tensor,np.ndarray]]=None, n_bins:Optional[int]=None,
+              floor:float=1e-7, normalise:bool=True, reduce:Optional[Callable[[Tensor],Tensor]]=None) -> Tensor:
+    r'''Histogram events into shapes of shape (..., n_bins), on the device of `preds`: model outputs of shape (..., n_events, n_outputs), or integer bin indeces of shape (..., n_events).
+    Leading dimensions, e.g. variations of inputs, are histogrammed in a single pass.
+    In `'soft'` mode, bins are the sums over events of the outputs, e.g. softmax probabilities, and so are differentiable.
+    In `'hard'` mode, bins are the counts of events per bin index: integer `preds`, otherwise the argmax of multi-class outputs, or single outputs binned according to `bins`, as per `bin_preds`.
+    Indeces outside of [0,`n_bins`) are ignored, and `n_bins` defaults to the number of outputs, or of `bins` less one. Hard counts are float64, and normalised hard shapes are returned as float32.
+    Events are weighted by `w` (..., n_events) or (n_events, 1), if set. `reduce` is applied to the sums, e.g. `all_reduce_sum`, before `floor` is added to avoid empty bins.'''
+    if mode == 'soft':
+        f = (preds if w is None else preds*(w if w.dim() > 1 and w.shape[-1] == 1 else w[...,None])).sum(-2)
+    elif mode == 'hard':
+        if bins is not None: bins = torch.as_tensor(bins, device=preds.device)
+        if n_bins is None: n_bins = len(bins)-1 if bins is not None else preds.shape[-1]
+        idxs = preds if not preds.is_floating_point() else _preds_to_bins(preds, bins)
+        lead,n_var = idxs.shape[:-1],idxs[...,0].numel()
+        m = (idxs >= 0)&(idxs < n_bins)
+        idxs = idxs+(n_bins*torch.arange(n_var, device=idxs.device).view(*lead,1))  # Offset bins of each variation
+        if w is not None: w = (w[...,0] if w.dim() > 1 and w.shape[-1] == 1 else w).expand_as(idxs)[m].double()
+        f = torch.bincount(idxs[m], weights=w, minlength=n_bins*n_var).view(*lead,n_bins).double()
+    else:
+        raise ValueError(f'Mode {mode} not recognised, use "soft" or "hard"')
+    if reduce is not None: f = reduce(f)
+    f = f+floor
+    if normalise: f = f/f.sum(-1, keepdim=True)
+    return f.float() if mode == 'hard' and normalise else f
 
 # Cell
 def bin_preds(df:pd.DataFrame, bins:np.ndarray=np.linspace(0.,10.,11), pred_name='pred') -> None:
     '''Bins predictions over specified range'''
-    df[f'{pred_name}_bin'] = np.digitize(df[pred_name], bins)-1
+    p = torch.as_tensor(df[pred_name].values, dtype=torch.float64)
+    df[f'{pred_name}_bin'] = to_np(_preds_to_bins(p[:,None], torch.as_tensor(bins, dtype=torch.float64)))
 
 # Cell
 def get_shape(df:pd.DataFrame, targ:int, bins:np.ndarray=np.linspace(0.,10.,11), pred_name:str='pred_bin') -> Tensor:
-    r'''Extracts normalised shape of class from binned predictions. Empty bins are filled with a small quantity to avoid zeros.'''
-    f = df.loc[df.gen_target == targ, pred_name].value_counts(bins=bins-(1/len(bins)))
-    f.sort_index(inplace=True)
-    f += 1e-7
-    f /= f.sum()
-    return Tensor(f.values)
-
-# Cell
-def get_paper_syst_shapes(bkg_data:np.ndarray, df:pd.DataFrame, model:ModelWrapper, bins:np.ndarray=np.linspace(0.,10.,11), pred_cb:PredHandler=PredHandler(),
-                          r_vals:Tuple[float,float,float]=[-0.2,0,0.2], l_vals:Tuple[float]=[2.5,3,3.5]) -> OrderedDict:
-    r'''Pass background data through trained model in order to get up/down shape variations.'''
-    def _get_shape(r,l):
-        bp = model.predict(bkg_data, pred_cb=pred_cb, cbs=PaperSystMod(r=r,l=l))
-        n = f'pred_{r}_{l}'
-        df[n] = df.pred
-        df.loc[df.gen_target == 0, n] = bp
-        bin_preds(df, pred_name=n, bins=bins)
-        return get_shape(df=df, targ=0, bins=np.linspace(0.,len(bins)-1,len(bins)), pred_name=f'{n}_bin')
-
-    shapes = OrderedDict()
-    for i,r in enumerate(r_vals):
-        print(f'Running: r={r}')
-        shapes[f'{i}_{1}'] = _get_shape(r,l_vals[1])
-    for i,l in enumerate(l_vals):
-        print(f'Running: l={l}')
-        shapes[f'{1}_{i}'] = _get_shape(r_vals[1],l)
-    return OrderedDict((('f_b_nom',shapes['1_1']),
-                        ('f_b_up', torch.stack((shapes['2_1'],shapes['1_2']))),
-                        ('f_b_dw', torch.stack((shapes['0_1'],shapes['1_0'])))))
+    r'''Extracts normalised shape of class from binned predictions. Empty bins are filled with a small quantity to avoid zeros.
+    For large datasets, `histogram` can be used directly on tensors of predictions, rather than passing them through a `DataFrame`.'''
+    return histogram(torch.as_tensor(df.loc[df.gen_target == targ, pred_name].values, dtype=torch.long), mode='hard', n_bins=len(bins)-1)
+
+# Cell
+def _split_syst_shapes(f:Tensor) -> OrderedDict:
+    return OrderedDict((('f_b_nom',f[0]),
+                        ('f_b_up', f[1:3]),
+                        ('f_b_dw', f[3:5])))
+
+def get_paper_syst_shapes(bkg_data:Union[np.ndarray,Tensor], df:Optional[pd.DataFrame], model:ModelWrapper, bins:np.ndarray=np.linspace(0.,10.,11),
+                          pred_cb:Optional[PredHandler]=None, r_vals:Tuple[float,float,float]=[-0.2,0,0.2], l_vals:Tuple[float]=[2.5,3,3.5],
+                          pred_func:Optional[Callable[[Tensor,Tensor],Tensor]]=None, bs:int=100000, cache:Optional[PredCache]=None) -> OrderedDict:
+    r'''Pass background data through trained model in order to get up/down shape variations.
+    All variations are stacked along the batch dimension, so each batch of `bs` events passes through the model once, and predictions are histogrammed directly into tensors.
+    `pred_func` maps model outputs and bin edges to bin indeces, by default `_preds_to_bins`. `df` and `pred_cb` are no longer used.
+    Shapes are cached in `cache`, or the default cache set via `set_pred_cache`, keyed by the model, `bkg_data`, `bins`, `r_vals`, `l_vals`, and `pred_func`.'''
+    if pred_func is None: pred_func = _preds_to_bins
+    if cache is None: cache = get_pred_cache()
+    if cache is not None:
+        key = fingerprint('paper_syst_shapes', model.model, bkg_data, bins, r_vals, l_vals, pred_func)
+        res = cache.get(key)
+        if res is not None: return _split_syst_shapes(torch.from_numpy(res['f']))
+    alpha = Tensor([[r_vals[1], l_vals[1]], [r_vals[2], l_vals[1]], [r_vals[1], l_vals[2]], [r_vals[0], l_vals[1]], [r_vals[1], l_vals[0]]])  # Nominal, up, down
+    alpha,transform = (alpha-Tensor([0,3])).to(model.device),paper_nuisances()  # As per `PaperSystMod`
+    edges = torch.as_tensor(bins, dtype=torch.float32, device=model.device)
+    n_var,n_bins = len(alpha),len(bins)-1
+    counts = torch.zeros(n_var, n_bins, dtype=torch.float64, device=model.device)
+    model.model.eval()
+    with torch.no_grad():
+        for i in progress_bar(range(0, len(bkg_data), bs)):
+            x = torch.as_tensor(bkg_data[i:i+bs], dtype=torch.float32, device=model.device)
+            x = transform(x, alpha)
+            b = pred_func(model.model(x.reshape(-1,x.shape[-1])), edges).reshape(n_var,-1)
+            counts += histogram(b, mode='hard', n_bins=n_bins, floor=0, normalise=False)
+    f = counts.cpu()+1e-7
+    f = (f/f.sum(1, keepdim=True)).float()
+    if cache is not None: cache.set(key, {'f':to_np(f)})
+    return _split_syst_shapes(f)
 
 # Cell
 def get_likelihood_width(nll:np.ndarray, mu_scan:np.ndarray, val:float=0.5) -> float:
-    r'''Compute width of likelihood at 95% confidence-level'''
+    r'''Compute width of likelihood at 95% confidence-level via spline interpolation. See `get_likelihood_widths` for batches of curves.'''
     m = nll == nll
     r = InterpolatedUnivariateSpline(mu_scan[m], nll[m]-val-nll[m].min()).roots()
     if len(r) != 2: raise ValueError(f'No roots found at {val}, set val to a smaller value.')
     return (r[1]-r[0])/2
 
+# Cell
+def _parabola(x:Tensor, y:Tensor) -> Tuple[Tensor,Tensor,Tensor]:
+    r'''Coefficients A, B, C of parabolas A*u^2+B*u+C through sets of three points, shape (n_curves, 3), with u measured from the first point'''
+    h1,h2 = x[:,1]-x[:,0],x[:,2]-x[:,1]
+    f01,f12 = (y[:,1]-y[:,0])/h1,(y[:,2]-y[:,1])/h2
+    a = (f12-f01)/(h1+h2)
+    return a,f01-(a*h1),y[:,0]
+
+def _interp_crossing(mu:Tensor, d:Tensor, j:Tensor, k:Tensor, interp:str) -> Tensor:
+    r'''Interpolate the roots of curves `d` between points `j` and `j+1`, using point `k` for quadratic interpolation, falling back to linear interpolation'''
+    rows = torch.arange(len(d))
+    xa,xb,ya,yb = mu[j],mu[j+1],d[rows,j],d[rows,j+1]
+    lin = xa-(ya*(xb-xa)/(yb-ya))
+    if interp == 'linear': return lin
+    a,b,c = _parabola(torch.stack((xa,xb,mu[k]), 1), torch.stack((ya,yb,d[rows,k]), 1))
+    disc = (b**2)-(4*a*c)
+    q = -0.5*(b+torch.copysign(disc.clamp_min(0).sqrt(), b))  # Numerically stable roots q/a and c/q
+    u = torch.stack((q/a, c/q), 1)
+    u = torch.where(u.isfinite() & (u >= 0) & (u <= (xb-xa)[:,None]) & (disc >= 0)[:,None], u, torch.full_like(u, math.nan))
+    u = torch.where(u[:,0].isnan(), u[:,1], u[:,0])
+    return torch.where(u.isnan(), lin, xa+u)
+
+def get_likelihood_widths(nll:Union[Tensor,np.ndarray], mu_scan:Union[Tensor,np.ndarray], val:float=0.5, interp:str='quadratic',
+                          nll_func:Optional[Callable[[Tensor],Tensor]]=None, n_bisect:int=20) -> Tensor:
+    r'''Compute widths of batches of likelihood curves, `nll` with shape (n_curves, n_mu) or (n_mu), at `val` above their minima, for all curves simultaneously.
+    The minimum of each curve is interpolated by a parabola through its lowest point and neighbours, and the crossings either side of the minimum
+    by a parabola (`interp='quadratic'`) or line (`interp='linear'`) through the points bracketing them.
+    Curves whose crossings cannot be found, e.g. curves not rising by `val` within the scan, or whose crossings are bracketed by NaNs, have NaN widths, rather than raising.
+    Crossings can be refined by `n_bisect` steps of bisection within their brackets on `nll_func`, which maps mu values, shape (n_curves, 2),
+    to the NLL of each curve, e.g. profiled via `calc_profile`. `mu_scan` should be increasing.'''
+    nll,mu = torch.as_tensor(nll, dtype=torch.float64),torch.as_tensor(mu_scan, dtype=torch.float64, device=getattr(nll, 'device', None))
+    shape,nll = nll.shape[:-1],nll.reshape(-1, nll.shape[-1])
+    n,m = nll.shape
+    rows,idxs = torch.arange(n, device=nll.device),torch.arange(m-1, device=nll.device)[None]
+    # Minima
+    i_min = nll.nan_to_num(math.inf).argmin(1)
+    nll_min = nll[rows,i_min]
+    i = i_min.clamp(1, m-2)
+    a,b,c = _parabola(torch.stack((mu[i-1],mu[i],mu[i+1]), 1), torch.stack((nll[rows,i-1],nll[rows,i],nll[rows,i+1]), 1))
+    nll_min = torch.where((i == i_min) & (a > 0), torch.minimum(c-((b**2)/(4*a)), nll_min), nll_min)
+    # Bracket crossings either side of minima
+    d = nll-nll_min[:,None]-val
+    above,below = d >= 0,d < 0
+    j = torch.where(above[:,:-1] & below[:,1:] & (idxs < i_min[:,None]), idxs, torch.full_like(idxs, -1)).max(1).values  # Closest falling crossing below minimum
+    k = torch.where(below[:,:-1] & above[:,1:] & (idxs >= i_min[:,None]), idxs, torch.full_like(idxs, m)).min(1).values  # Closest rising crossing above minimum
+    fail = (j < 0)|(k >= m-1)|nll_min.isnan()
+    j,k = j.clamp(0, m-2),k.clamp(0, m-2)
+    if nll_func is None:
+        lo = _interp_crossing(mu, d, j, torch.where(j > 0, j-1, j+2).clamp(max=m-1), interp)  # Third point away from minimum, where possible
+        hi = _interp_crossing(mu, d, k, torch.where(k < m-2, k+2, k-1).clamp(min=0), interp)
+    else:
+        left = torch.tensor([True,False], device=nll.device)
+        start,end = torch.stack((mu[j],mu[k]), 1),torch.stack((mu[j+1],mu[k+1]), 1)
+        for _ in range(n_bisect):
+            mid = (start+end)/2
+            move_start = (torch.as_tensor(nll_func(mid)).to(mid)-nll_min[:,None]-val >= 0) == left  # NLL above val on left side, or below on right side
+            start,end = torch.where(move_start, mid, start),torch.where(move_start, end, mid)
+        lo,hi = ((start+end)/2).unbind(1)
+    return torch.where(fail, torch.full_like(hi, math.nan), (hi-lo)/2).reshape(shape)
+
 # Cell
 def interp_shape(alpha:Tensor, f_nom:Tensor, f_up:Tensor, f_dw:Tensor):
     r'''Use quadratic interpolation between up/down systematic shapes and nominal in order to estimate shapes at arbitrary nuisance values.
@@ -83,71 +191,215 @@ def interp_shape(alpha:Tensor, f_nom:Tensor, f_up:Tensor, f_dw:Tensor):
     return (f_nom + abs_var.sum(1, keepdim=True)).squeeze(1)
 
 # Cell
-def calc_nll(s_true:float, b_true:float, mu:Tensor, f_s_nom:Tensor, f_b_nom:Tensor,
-             shape_alpha:Optional[Tensor]=None, s_norm_alpha:Optional[Tensor]=None, b_norm_alpha:Optional[Tensor]=None,
-             f_s_up:Optional[Tensor]=None, f_s_dw:Optional[Tensor]=None,
-             f_b_up:Optional[Tensor]=None, f_b_dw:Optional[Tensor]=None,
-             s_norm_aux:Optional[Distribution]=None, b_norm_aux:Optional[Distribution]=None, shape_aux:Optional[List[Distribution]]=None) -> Tensor:
-    r'''Compute negative log-likelihood for specified parameters.'''
+def calc_batch_nll(s_true:float, b_true:float, mu:Tensor, f_s_nom:Tensor, f_b_nom:Tensor,
+                   shape_alpha:Optional[Tensor]=None, s_norm_alpha:Optional[Tensor]=None, b_norm_alpha:Optional[Tensor]=None,
+                   f_s_up:Optional[Tensor]=None, f_s_dw:Optional[Tensor]=None,
+                   f_b_up:Optional[Tensor]=None, f_b_dw:Optional[Tensor]=None,
+                   s_norm_aux:Optional[List[Distribution]]=None, b_norm_aux:Optional[List[Distribution]]=None,
+                   shape_aux:Optional[List[Distribution]]=None, obs:Optional[Tensor]=None) -> Tensor:
+    r'''Compute negative log-likelihoods for a batch of parameter points.
+    `mu` should have shape (n_points) and the nuisances should have shape (n_points, n_nuisances). Returns a tensor of shape (n_points).
+    Observed counts per bin can be passed via `obs`, either common to all points or with shape (n_points, n_bins); otherwise the Asimov dataset is used.'''
     #  Adjust expectation by nuisances
     f_s = interp_shape(shape_alpha, f_s_nom, f_s_up, f_s_dw) if shape_alpha is not None and f_s_up is not None else f_s_nom
     f_b = interp_shape(shape_alpha, f_b_nom, f_b_up, f_b_dw) if shape_alpha is not None and f_b_up is not None  else f_b_nom
-    s_exp = mu    +s_norm_alpha.sum() if s_norm_alpha is not None else mu
-    b_exp = b_true+b_norm_alpha.sum() if b_norm_alpha is not None else b_true
+    s_exp = mu[:,None]+s_norm_alpha.sum(1, keepdim=True) if s_norm_alpha is not None else mu[:,None]
+    b_exp = b_true    +b_norm_alpha.sum(1, keepdim=True) if b_norm_alpha is not None else b_true
     #  Compute NLL
     t_exp = (s_exp*f_s)+(b_exp*f_b)
-    asimov = (s_true*f_s_nom)+(b_true*f_b_nom)
-    nll = -torch.distributions.Poisson(t_exp, False).log_prob(asimov).sum()
+    asimov = (s_true*f_s_nom)+(b_true*f_b_nom) if obs is None else obs
+    nll = -torch.distributions.Poisson(t_exp, False).log_prob(asimov).sum(-1)
     # Constrain nuisances
     if shape_aux is not None:
-        if len(shape_aux) != len(shape_alpha): raise ValueError("Number of auxillary measurements must match the number of nuisance parameters.\
-                                                           Pass `None`s for unconstrained nuisances.")
-        for a,x in zip(shape_alpha, shape_aux):
-            if x is not None: nll = nll-x.log_prob(a)
+        if len(shape_aux) != shape_alpha.shape[-1]: raise ValueError("Number of auxillary measurements must match the number of nuisance parameters.\
+                                                                     Pass `None`s for unconstrained nuisances.")
+        for i,x in enumerate(shape_aux):
+            if x is not None: nll = nll-x.log_prob(shape_alpha[:,i])
     if b_norm_alpha is not None:
-        for a,x in zip(b_norm_alpha, b_norm_aux): nll = nll-x.log_prob(a)
+        for i,x in enumerate(b_norm_aux): nll = nll-x.log_prob(b_norm_alpha[:,i])
     if s_norm_alpha is not None:
-        for a,x in zip(s_norm_alpha, s_norm_aux): nll = nll-x.log_prob(a)
+        for i,x in enumerate(s_norm_aux): nll = nll-x.log_prob(s_norm_alpha[:,i])
     return nll
 
+# Cell
+def calc_nll(s_true:float, b_true:float, mu:Tensor, f_s_nom:Tensor, f_b_nom:Tensor,
+             shape_alpha:Optional[Tensor]=None, s_norm_alpha:Optional[Tensor]=None, b_norm_alpha:Optional[Tensor]=None,
+             f_s_up:Optional[Tensor]=None, f_s_dw:Optional[Tensor]=None,
+             f_b_up:Optional[Tensor]=None, f_b_dw:Optional[Tensor]=None,
+             s_norm_aux:Optional[Distribution]=None, b_norm_aux:Optional[Distribution]=None, shape_aux:Optional[List[Distribution]]=None) -> Tensor:
+    r'''Compute negative log-likelihood for specified parameters. Single-point version of `calc_batch_nll`.'''
+    return calc_batch_nll(s_true=s_true, b_true=b_true, mu=torch.as_tensor(mu, device=f_b_nom.device).reshape(1), f_s_nom=f_s_nom, f_b_nom=f_b_nom,
+                          shape_alpha=shape_alpha[None] if shape_alpha is not None else None,
+                          s_norm_alpha=s_norm_alpha[None] if s_norm_alpha is not None else None,
+                          b_norm_alpha=b_norm_alpha[None] if b_norm_alpha is not None else None,
+                          f_s_up=f_s_up, f_s_dw=f_s_dw, f_b_up=f_b_up, f_b_dw=f_b_dw,
+                          s_norm_aux=s_norm_aux, b_norm_aux=b_norm_aux, shape_aux=shape_aux)[0]
+
 # Cell
 def jacobian(y:Tensor, x:Tensor, create_graph=False):
     r'''Compute full jacobian matrix for single tensor. Call twice for hessian.
     Copied from https://gist.github.com/apaszke/226abdf867c4e9d6698bd198f3b45fb7 credits: Adam Paszke
-    TODO: Fix this to work batch-wise (maybe https://gist.github.com/sbarratt/37356c46ad1350d4c30aefbd488a4faa)'''
+    Requires one backward pass per element of y, see `vmap_jacobian` for a vectorised version.'''
     jac = []
     flat_y = y.reshape(-1)
-    grad_y = torch.zeros_like(flat_y)
     for i in range(len(flat_y)):
+        grad_y = torch.zeros_like(flat_y)  # New tensor each time, since in-place modification breaks higher-order derivatives when create_graph is True
         grad_y[i] = 1.
         grad_x, = torch.autograd.grad(flat_y, x, grad_y, retain_graph=True, create_graph=create_graph)
         jac.append(grad_x.reshape(x.shape))
-        grad_y[i] = 0.
     return torch.stack(jac).reshape(y.shape + x.shape)
 
 # Cell
-def calc_grad_hesse(nll:Tensor, alpha:Tensor, create_graph:bool=False) -> Tuple[Tensor,Tensor]:
-    r'''Compute full hessian and jacobian for single tensor'''
-    grad = jacobian(nll, alpha, create_graph=True)
-    hesse = jacobian(grad, alpha, create_graph=create_graph)
+def vmap_jacobian(y:Tensor, x:Tensor, create_graph=False):
+    r'''Compute full jacobian matrix for single tensor by vectorising the vector-jacobian products over the rows of an identity matrix, requiring only a single backward pass.
+    Call twice for hessian. Falls back to `jacobian` for versions of PyTorch without batched gradients (< 1.11).'''
+    if 'is_grads_batched' not in inspect.signature(torch.autograd.grad).parameters: return jacobian(y, x, create_graph=create_graph)
+    flat_y = y.reshape(-1)
+    grad_y = torch.eye(len(flat_y), device=flat_y.device, dtype=flat_y.dtype)
+    jac, = torch.autograd.grad(flat_y, x, grad_y, retain_graph=True, create_graph=create_graph, is_grads_batched=True)
+    return jac.reshape(y.shape + x.shape)
+
+# Cell
+def calc_grad_hesse(nll:Tensor, alpha:Tensor, create_graph:bool=False, method:str='loop', idxs:Optional[List[int]]=None) -> Tuple[Tensor,Tensor]:
+    r'''Compute full hessian and jacobian for single tensor.
+    `method` selects the jacobian computation: 'loop' for `jacobian` (one backward pass per element), or 'vmap' for `vmap_jacobian` (single vectorised backward pass).
+    If `idxs` is set, only the rows of the hessian for those elements of `alpha` are computed, with shape (len(idxs), len(alpha)).'''
+    jac_funcs = {'loop':jacobian, 'vmap':vmap_jacobian}
+    if method not in jac_funcs: raise ValueError(f"method must be one of {list(jac_funcs.keys())}, not {method}")
+    grad = jac_funcs[method](nll, alpha, create_graph=True)
+    hesse = jac_funcs[method](grad if idxs is None else grad[idxs], alpha, create_graph=create_graph)
     return grad, hesse
 
+def calc_poi_var(hesse:Tensor, poi_idx:int=0) -> Tensor:
+    r'''Compute the variance of the POI, i.e. element `poi_idx` of the diagonal of the inverse of `hesse`, shape (..., n_params, n_params).
+    The variance is the inverse of the Schur complement of the nuisance block of `hesse`, which requires a single linear solve, rather than a full matrix inverse.'''
+    nui = [i for i in range(hesse.shape[-1]) if i != poi_idx]
+    h_pp = hesse[...,poi_idx,poi_idx]
+    if len(nui) == 0: return 1/h_pp
+    h_np = hesse[...,nui,poi_idx]
+    z = torch.linalg.solve(hesse[...,nui,:][...,nui], h_np.unsqueeze(-1)).squeeze(-1)
+    return 1/(h_pp-(h_np*z).sum(-1))
+
 # Cell
-def calc_profile(f_s_nom:Tensor, f_b_nom:Tensor, n_obs:int, mu_scan:Tensor, mu_true:int,
-                 f_s_up:Optional[Tensor]=None, f_s_dw:Optional[Tensor]=None,
-                 f_b_up:Optional[Tensor]=None, f_b_dw:Optional[Tensor]=None,
-                 shape_aux:Optional[List[Distribution]]=None,
-                 s_norm_aux:Optional[List[Distribution]]=None, b_norm_aux:Optional[List[Distribution]]=None, nonaux_b_norm:bool=False,
-                 n_steps:int=100, lr:float=0.1,  verbose:bool=True) -> Tensor:
-    r'''Compute profile likelihoods for range of mu values, optimising on full hessian.
-    Ideally mu-values should be computed in parallel, but batch-wise hessian in PyTorch is difficult.'''
-    for f in [f_s_nom, f_s_up, f_s_dw, f_b_nom, f_b_up, f_b_dw]:  # Ensure correct dimensions
-        if f is not None and len(f.shape) < 2: f.unsqueeze_(0)
+def calc_batch_grad_hesse(nll:Tensor, alpha:Tensor, create_graph:bool=False) -> Tuple[Tensor,Tensor]:
+    r'''Compute gradients and hessians for a batch of independent nlls, each depending only on its own row of alpha.
+    Since the hessian of the summed nlls is block diagonal, all the hessians are computed with one backward pass per parameter, regardless of batch size.'''
+    grad, = autograd.grad(nll.sum(), alpha, create_graph=True)
+    hesse = torch.stack([autograd.grad(grad[:,i].sum(), alpha, retain_graph=True, create_graph=create_graph)[0] for i in range(alpha.shape[-1])], 1)
+    return grad, hesse
+
+# Cell
+def _interp_shape_derivs(alpha:Tensor, f_nom:Tensor, f_up:Tensor, f_dw:Tensor) -> Tuple[Tensor,Tensor]:
+    r'''First and second derivatives of `interp_shape` w.r.t. each nuisance, with shape (n_points, n_nuisances, n_bins)'''
+    alpha_t = alpha.unsqueeze(-1)
+    a = 0.5*(f_up+f_dw)-f_nom
+    b = 0.5*(f_up-f_dw)
+    inner = torch.abs(alpha_t) <= 1.
+    d1 = torch.where(inner, 2*a*alpha_t+b, b+(torch.sign(alpha_t)*a))
+    d2 = torch.where(inner, 2*a*torch.ones_like(alpha_t), torch.zeros_like(d1))
+    return d1, d2
+
+# Cell
+def _no_compile(f:Callable) -> Callable:
+    r'''Exclude function from compilation by `torch.compile`, if available'''
+    return torch.compiler.disable(f) if hasattr(torch, 'compiler') and hasattr(torch.compiler, 'disable') else f
+
+@_no_compile
+def _autograd_aux_grad_hesse(x:Tensor, aux:List[Tuple[int,Distribution]]) -> Tuple[Tensor,Tensor,Tensor]:
+    x = x.detach().requires_grad_(True)
+    with torch.enable_grad():
+        nll = -sum(d.log_prob(x[:,i]) for i,d in aux)
+        grad, = autograd.grad(nll.sum(), x, create_graph=True)
+        hesse, = autograd.grad(grad.sum(), x, allow_unused=True) if grad.requires_grad else (None,)
+    return nll.detach(), grad.detach(), torch.zeros_like(x) if hesse is None else hesse
+
+def _aux_grad_hesse(alpha:Tensor, aux:Optional[List[Distribution]]) -> Tuple[Tensor,Tensor,Tensor]:
+    r'''Compute nll, gradient, and diagonal hessian of auxiliary measurements for a batch of nuisances.
+    Normal distributions are computed in closed form. Since each other auxiliary measurement depends on only one nuisance, two backward passes suffice for them.'''
+    x = alpha.detach()
+    nll,grad,hesse,other = x.new_zeros(len(x)),torch.zeros_like(x),torch.zeros_like(x),[]
+    for i,d in enumerate(aux if aux is not None else []):
+        if d is None: continue
+        if isinstance(d, Normal):
+            nll = nll-d.log_prob(x[:,i])
+            grad[:,i] = (x[:,i]-d.loc)/d.scale.pow(2)
+            hesse[:,i] = d.scale.pow(-2)
+        else:
+            other.append((i,d))
+    if len(other) > 0:
+        o_nll,o_grad,o_hesse = _autograd_aux_grad_hesse(x, other)
+        nll,grad,hesse = nll+o_nll,grad+o_grad,hesse+o_hesse
+    return nll, grad, hesse
+
+# Cell
+def calc_analytic_grad_hesse(s_true:float, b_true:float, mu:Tensor, f_s_nom:Tensor, f_b_nom:Tensor,
+                             shape_alpha:Optional[Tensor]=None, s_norm_alpha:Optional[Tensor]=None, b_norm_alpha:Optional[Tensor]=None,
+                             f_s_up:Optional[Tensor]=None, f_s_dw:Optional[Tensor]=None,
+                             f_b_up:Optional[Tensor]=None, f_b_dw:Optional[Tensor]=None,
+                             s_norm_aux:Optional[List[Distribution]]=None, b_norm_aux:Optional[List[Distribution]]=None,
+                             shape_aux:Optional[List[Distribution]]=None, obs:Optional[Tensor]=None) -> Tuple[Tensor,Tensor,Tensor]:
+    r'''Compute negative log-likelihoods, gradients, and hessians for a batch of parameter points, using closed-form derivatives rather than autograd.
+    Arguments are the same as `calc_batch_nll`. Derivatives are w.r.t. the parameters ordered as (mu, shape nuisances, signal-norm nuisances, background-norm nuisances),
+    i.e. gradients have shape (n_points, n_params) and hessians have shape (n_points, n_params, n_params).
+    Results remain differentiable w.r.t. the shapes, e.g. for use in the INFERNO loss.'''
+    n = len(mu)
+    zeros = mu.new_zeros((n,0))
+    if shape_alpha is None: shape_alpha = zeros
+    if s_norm_alpha is None: s_norm_alpha = zeros
+    if b_norm_alpha is None: b_norm_alpha = zeros
+    k,n_s,n_b = shape_alpha.shape[-1],s_norm_alpha.shape[-1],b_norm_alpha.shape[-1]
+    #  Adjust expectation by nuisances
+    f_s = interp_shape(shape_alpha, f_s_nom, f_s_up, f_s_dw) if k > 0 and f_s_up is not None else f_s_nom
+    f_b = interp_shape(shape_alpha, f_b_nom, f_b_up, f_b_dw) if k > 0 and f_b_up is not None else f_b_nom
+    f_s,f_b = f_s.expand(n,f_s.shape[-1]),f_b.expand(n,f_b.shape[-1])
+    s_exp = mu[:,None]+s_norm_alpha.sum(1, keepdim=True)
+    b_exp = b_true    +b_norm_alpha.sum(1, keepdim=True)
+    t_exp = (s_exp*f_s)+(b_exp*f_b)
+    asimov = (s_true*f_s_nom)+(b_true*f_b_nom) if obs is None else obs
+    nll = -torch.distributions.Poisson(t_exp, False).log_prob(asimov).sum(-1)
+    # Derivatives of the Poisson nll w.r.t. expected counts
+    r = 1-(asimov/t_exp)
+    w = asimov/t_exp.pow(2)
+    # Derivatives of expected counts w.r.t. shape nuisances
+    d1_s,d2_s = _interp_shape_derivs(shape_alpha, f_s_nom, f_s_up, f_s_dw) if k > 0 and f_s_up is not None else (0,0)
+    d1_b,d2_b = _interp_shape_derivs(shape_alpha, f_b_nom, f_b_up, f_b_dw) if k > 0 and f_b_up is not None else (0,0)
+    dt_da = (s_exp[...,None]*d1_s)+(b_exp[...,None]*d1_b)+t_exp.new_zeros((n,k,t_exp.shape[-1]))
+    jac = torch.cat((f_s[:,None], dt_da, f_s[:,None].expand(n,n_s,-1), f_b[:,None].expand(n,n_b,-1)), 1)
+    grad = (jac*r[:,None]).sum(-1)
+    hesse = (jac*w[:,None])@jac.transpose(1,2)
+    # Second derivatives of expected counts: only nuisance-nuisance diagonal & mixed nuisance-norm terms are non-zero
+    if k > 0:
+        cross_s = (d1_s*r[:,None]).sum(-1) if f_s_up is not None else t_exp.new_zeros((n,k))
+        cross_b = (d1_b*r[:,None]).sum(-1) if f_b_up is not None else t_exp.new_zeros((n,k))
+        diag = (((s_exp[...,None]*d2_s)+(b_exp[...,None]*d2_b))*r[:,None]).sum(-1)+t_exp.new_zeros((n,k))
+        mix = torch.cat((cross_s[:,None], torch.diag_embed(0.5*diag), cross_s[:,None].expand(n,n_s,k), cross_b[:,None].expand(n,n_b,k)), 1)
+        sel = torch.zeros((k,1+k+n_s+n_b), device=mix.device, dtype=mix.dtype)
+        sel[:,1:1+k] = torch.eye(k, device=mix.device, dtype=mix.dtype)
+        mix = mix@sel
+        hesse = hesse+mix+mix.transpose(1,2)
+    # Constrain nuisances
+    if shape_aux is not None and len(shape_aux) != k: raise ValueError("Number of auxillary measurements must match the number of nuisance parameters.\
+                                                                       Pass `None`s for unconstrained nuisances.")
+    aux = [_aux_grad_hesse(a, x) for a,x in ((shape_alpha,shape_aux), (s_norm_alpha,s_norm_aux), (b_norm_alpha,b_norm_aux))]
+    nll = nll+sum(o[0] for o in aux)
+    grad = grad+torch.cat([mu.new_zeros((n,1))]+[o[1] for o in aux], 1)
+    hesse = hesse+torch.diag_embed(torch.cat([mu.new_zeros((n,1))]+[o[2] for o in aux], 1))
+    return nll, grad, hesse
+
+# Cell
+def _get_nuisances(f_s_nom:Tensor, f_b_nom:Tensor, f_s_up:Optional[Tensor]=None, f_s_dw:Optional[Tensor]=None,
+                   f_b_up:Optional[Tensor]=None, f_b_dw:Optional[Tensor]=None,
+                   s_norm_aux:Optional[List[Distribution]]=None, b_norm_aux:Optional[List[Distribution]]=None,
+                   nonaux_b_norm:bool=False) -> Tuple[Dict[str,Any],Tuple[List[int],List[int],List[int]]]:
+    r'''Format templates and auxiliary measurements for `calc_batch_nll`, and compute the indeces of the shape, signal-norm, and background-norm nuisances.
+    Input templates are not modified.'''
+    f_s_nom,f_s_up,f_s_dw,f_b_nom,f_b_up,f_b_dw = [f.unsqueeze(0) if f is not None and len(f.shape) < 2 else f  # Ensure correct dimensions
+                                                   for f in [f_s_nom,f_s_up,f_s_dw,f_b_nom,f_b_up,f_b_dw]]
     # Cases where nuisance only causes up xor down variation
     if (f_s_up is None and f_s_dw is not None): f_s_up = torch.repeat_interleave(f_s_nom, repeats=len(f_s_dw), dim=0)
     if (f_s_dw is None and f_s_up is not None): f_s_dw = torch.repeat_interleave(f_s_nom, repeats=len(f_s_up), dim=0)
-    if (f_b_up is None and f_b_dw is not None): f_b_up = torch.repeat_interleave(f_s_nom, repeats=len(f_b_dw), dim=0)
-    if (f_b_dw is None and f_b_up is not None): f_b_dw = torch.repeat_interleave(f_s_nom, repeats=len(f_b_up), dim=0)
+    if (f_b_up is None and f_b_dw is not None): f_b_up = torch.repeat_interleave(f_b_nom, repeats=len(f_b_dw), dim=0)
+    if (f_b_dw is None and f_b_up is not None): f_b_dw = torch.repeat_interleave(f_b_nom, repeats=len(f_b_up), dim=0)
     if f_s_up is not None and f_b_up is not None and len(f_s_up) != len(f_b_up):
         raise ValueError("Shape variations for signal & background must have the same number of variations. \
                           Please enter the nominal templates for nuisances that only affect either signal of background.")
@@ -160,26 +412,317 @@ def calc_profile(f_s_nom:Tensor, f_b_nom:Tensor, n_obs:int, mu_scan:Tensor, mu_t
     s_norm_idxs = list(range(n_alpha, n_alpha+len(s_norm_aux)))
     n_alpha += len(s_norm_aux)
     b_norm_idxs = list(range(n_alpha, n_alpha+len(b_norm_aux)+nonaux_b_norm))
-    n_alpha += len(b_norm_aux)+nonaux_b_norm
+    return (dict(f_s_nom=f_s_nom, f_s_up=f_s_up, f_s_dw=f_s_dw, f_b_nom=f_b_nom, f_b_up=f_b_up, f_b_dw=f_b_dw, s_norm_aux=s_norm_aux, b_norm_aux=b_norm_aux),
+            (shape_idxs,s_norm_idxs,b_norm_idxs))
+
+# Cell
+def _interp_coefs(f_nom:Tensor, f_up:Tensor, f_dw:Tensor) -> Tuple[Tensor,Tensor]:
+    r'''Quadratic and linear coefficients of `interp_shape` for each nuisance, shape (n_nuisances, n_bins)'''
+    return 0.5*(f_up+f_dw)-f_nom,0.5*(f_up-f_dw)
+
+def _interp_var(alpha:Tensor, a:Tensor, b:Tensor) -> Tensor:
+    r'''Shape variation of `interp_shape` summed over nuisances, shape (n_points, n_bins), from precomputed coefficients.
+    Beyond the up/down shapes, the linear extrapolation of `interp_shape` reduces to (b+sign(alpha)*a)*alpha, so the variation is a pair of matrix products.'''
+    return (torch.where(alpha.abs() > 1, alpha.abs(), alpha.square())@a)+(alpha@b)
+
+class TemplateModel():
+    r'''Binned likelihood of signal and background templates, built once for repeated evaluation of the NLL, e.g. by each step of a Newton minimisation.
+    Interpolation coefficients of the up/down shape variations and the Asimov dataset (or `obs`) are precomputed,
+    such that `nll` evaluates batches of parameter points via broadcasting and matrix products.
+    Arguments are as per `calc_batch_nll`, and nuisances are ordered as shape, signal-norm, and background-norm nuisances, as per `_get_nuisances`.
+    Templates can carry gradients, e.g. the shapes of a network, which then propagate through `nll`.'''
+    def __init__(self, s_true:float, b_true:float, f_s_nom:Tensor, f_b_nom:Tensor, f_s_up:Optional[Tensor]=None, f_s_dw:Optional[Tensor]=None,
+                 f_b_up:Optional[Tensor]=None, f_b_dw:Optional[Tensor]=None, shape_aux:Optional[List[Distribution]]=None,
+                 s_norm_aux:Optional[List[Distribution]]=None, b_norm_aux:Optional[List[Distribution]]=None, nonaux_b_norm:bool=False, obs:Optional[Tensor]=None):
+        store_attr('s_true, b_true, shape_aux')
+        self.templates,(self.shape_idxs,self.s_norm_idxs,self.b_norm_idxs) = _get_nuisances(f_s_nom=f_s_nom, f_b_nom=f_b_nom, f_s_up=f_s_up, f_s_dw=f_s_dw,
+                                                                                            f_b_up=f_b_up, f_b_dw=f_b_dw, s_norm_aux=s_norm_aux,
+                                                                                            b_norm_aux=b_norm_aux, nonaux_b_norm=nonaux_b_norm)
+        self.n_alpha = len(self.shape_idxs)+len(self.s_norm_idxs)+len(self.b_norm_idxs)
+        t = self.templates
+        self.f_s_nom,self.f_b_nom = t['f_s_nom'],t['f_b_nom']
+        self.s_coefs = _interp_coefs(t['f_s_nom'], t['f_s_up'], t['f_s_dw']) if t['f_s_up'] is not None else None
+        self.b_coefs = _interp_coefs(t['f_b_nom'], t['f_b_up'], t['f_b_dw']) if t['f_b_up'] is not None else None
+        self.obs = (s_true*self.f_s_nom)+(b_true*self.f_b_nom) if obs is None else obs
+        self.log_norm = torch.lgamma(self.obs+1)
+        if shape_aux is not None and len(shape_aux) != len(self.shape_idxs):
+            raise ValueError("Number of auxillary measurements must match the number of nuisance parameters. Pass `None`s for unconstrained nuisances.")
+        self.aux = [(i,x) for i,x in zip(self.shape_idxs, [None]*len(self.shape_idxs) if shape_aux is None else shape_aux) if x is not None]
+        self.aux += list(zip(self.s_norm_idxs, t['s_norm_aux']))+list(zip(self.b_norm_idxs, t['b_norm_aux']))
+
+    def nll(self, mu:Tensor, alpha:Tensor) -> Tensor:
+        r'''Compute negative log-likelihoods for a batch of parameter points, `mu` with shape (n_points) and `alpha` with shape (n_points, n_alpha)'''
+        shape_alpha = alpha[:,self.shape_idxs]
+        f_s = self.f_s_nom if self.s_coefs is None else self.f_s_nom+_interp_var(shape_alpha, *self.s_coefs)
+        f_b = self.f_b_nom if self.b_coefs is None else self.f_b_nom+_interp_var(shape_alpha, *self.b_coefs)
+        s_exp = mu[:,None]  +alpha[:,self.s_norm_idxs].sum(1, keepdim=True)
+        b_exp = self.b_true+alpha[:,self.b_norm_idxs].sum(1, keepdim=True)
+        t_exp = (s_exp*f_s)+(b_exp*f_b)
+        nll = (t_exp-torch.xlogy(self.obs, t_exp)+self.log_norm).sum(-1)  # Poisson, summed per bin to limit cancellation
+        for i,x in self.aux: nll = nll-x.log_prob(alpha[:,i])
+        return nll
+
+# Cell
+class NewtonSolver():
+    r'''Minimises a batch of independent problems via damped Newton's method, where `grad_hesse` returns the gradients (n_points, n_params) and hessians (n_points, n_params, n_params) at `alpha`.
+    Steps are solved via Cholesky decomposition of the hessian plus `damping` times the identity, falling back to `torch.linalg.solve` for hessians which are not positive definite.
+    Each point stops being updated once its largest absolute step falls below `step_tol`, or the norm of its gradient falls below `grad_tol`.
+    If an `nll` function is passed when called, steps which do not decrease the NLL are halved up to `n_halvings` times (backtracking line search).
+    If `warm_start` is true, minimisation starts from the solution of the previous call, when the number of points and parameters match.
+    The number of iterations run for each point in the last call are stored in `n_iters`.'''
+    def __init__(self, n_steps:int=100, lr:float=0.1, step_tol:float=1e-5, grad_tol:float=0, damping:float=0, max_step:float=100, n_halvings:int=0,
+                 warm_start:bool=False):
+        store_attr()
+        self.reset()
+
+    def reset(self) -> None: self.alpha_prev,self.n_iters = None,None
+
+    def _solve(self, grad:Tensor, hesse:Tensor) -> Tensor:
+        if self.damping > 0: hesse = hesse+(self.damping*torch.eye(hesse.shape[-1], dtype=hesse.dtype, device=hesse.device))
+        try:                 return torch.cholesky_solve(grad.unsqueeze(-1), torch.linalg.cholesky(hesse)).squeeze(-1)
+        except RuntimeError: return torch.linalg.solve(hesse, grad.unsqueeze(-1)).squeeze(-1)  # Not positive definite
+
+    def _line_search(self, nll:Callable[[Tensor],Tensor], alpha:Tensor, step:Tensor) -> Tensor:
+        with torch.no_grad():
+            nll0,t = nll(alpha),torch.ones_like(step[:,:1])
+            for _ in range(self.n_halvings):
+                worse = ~(nll(alpha-(t*step)) <= nll0)
+                if not worse.any(): break
+                t[worse] /= 2
+        return t*step
+
+    def __call__(self, grad_hesse:Callable[[Tensor],Tuple[Tensor,Tensor]], alpha:Tensor, nll:Optional[Callable[[Tensor],Tensor]]=None,
+                 verbose:bool=False) -> Tensor:
+        if self.warm_start and self.alpha_prev is not None and self.alpha_prev.shape == alpha.shape: alpha = self.alpha_prev.to(alpha.device)
+        alpha = alpha.detach().requires_grad_(True)
+        active = torch.ones(len(alpha), dtype=torch.bool, device=alpha.device)
+        self.n_iters = torch.zeros(len(alpha), dtype=torch.long, device=alpha.device)
+        for i in progress_bar(range(self.n_steps), display=verbose):
+            grad, hesse = grad_hesse(alpha)
+            grad, hesse = grad.detach(), hesse.detach()
+            self.n_iters += active
+            step = torch.clamp(self.lr*self._solve(grad, hesse), -self.max_step, self.max_step)*active[:,None]
+            if nll is not None and self.n_halvings > 0: step = self._line_search(nll, alpha.detach(), step)
+            alpha = (alpha-step).detach().requires_grad_(True)
+            active = active & (step.abs().max(1)[0] >= self.step_tol) & (grad.norm(dim=1) >= self.grad_tol)
+            if not active.any(): break
+        self.alpha_prev = alpha.detach().clone()
+        return alpha
+
+# Cell
+def calc_profile(f_s_nom:Tensor, f_b_nom:Tensor, n_obs:int, mu_scan:Tensor, mu_true:int,
+                 f_s_up:Optional[Tensor]=None, f_s_dw:Optional[Tensor]=None,
+                 f_b_up:Optional[Tensor]=None, f_b_dw:Optional[Tensor]=None,
+                 shape_aux:Optional[List[Distribution]]=None,
+                 s_norm_aux:Optional[List[Distribution]]=None, b_norm_aux:Optional[List[Distribution]]=None, nonaux_b_norm:bool=False,
+                 n_steps:int=100, lr:float=0.1, tol:float=1e-5, analytic:bool=False, solver:Optional[NewtonSolver]=None, verbose:bool=True) -> Tensor:
+    r'''Compute profile likelihoods for range of mu values, optimising on full hessian.
+    All mu-values are optimised in parallel via batch-wise hessians.
+    Each mu-value stops being updated once its largest absolute Newton step falls below `tol`; set `tol` to zero to always run `n_steps`.
+    A configured `NewtonSolver` can be passed via `solver`, in which case `n_steps`, `lr`, and `tol` are ignored.
+    If `analytic` is true, gradients and hessians are computed in closed form via `calc_analytic_grad_hesse`, rather than by autograd.
+    The likelihood is built once as a `TemplateModel` and reused by all Newton steps.'''
+    model = TemplateModel(s_true=mu_true, b_true=n_obs-mu_true, f_s_nom=f_s_nom, f_b_nom=f_b_nom, f_s_up=f_s_up, f_s_dw=f_s_dw, f_b_up=f_b_up, f_b_dw=f_b_dw,
+                          shape_aux=shape_aux, s_norm_aux=s_norm_aux, b_norm_aux=b_norm_aux, nonaux_b_norm=nonaux_b_norm)
+    shape_idxs,s_norm_idxs,b_norm_idxs = model.shape_idxs,model.s_norm_idxs,model.b_norm_idxs
+    mu_scan = mu_scan.to(f_b_nom.device)
+    alpha = torch.zeros((len(mu_scan),model.n_alpha), dtype=f_b_nom.dtype, device=f_b_nom.device)
+    if model.n_alpha > 0:
+        get_grad_hesse = partialler(calc_analytic_grad_hesse, s_true=mu_true, b_true=n_obs-mu_true, shape_aux=shape_aux, **model.templates)
+
+        def _grad_hesse(alpha:Tensor) -> Tuple[Tensor,Tensor]:
+            if analytic:
+                _, grad, hesse = get_grad_hesse(shape_alpha=alpha[:,shape_idxs], mu=mu_scan, s_norm_alpha=alpha[:,s_norm_idxs], b_norm_alpha=alpha[:,b_norm_idxs])
+                return grad[:,1:], hesse[:,1:,1:]  # Mu is not profiled
+            return calc_batch_grad_hesse(model.nll(mu_scan, alpha), alpha, create_graph=False)
+
+        if solver is None: solver = NewtonSolver(n_steps=n_steps, lr=lr, step_tol=tol)
+        alpha = solver(_grad_hesse, alpha, nll=lambda a: model.nll(mu_scan, a), verbose=verbose)  # Newton optimise nuisances
+        for mu,a in zip(mu_scan, alpha[:,shape_idxs].detach()):
+            if len(a) and a.abs().max() > 1: print(f'Linear regime: Mu {mu.data.item()}, shape nuisances {a.data}')
+    with torch.no_grad(): return model.nll(mu_scan, alpha)
 
+# Cell
+def _pad_bins(fs:List[Tensor], n_bins:int) -> Tensor:
+    r'''Zero-pad the last dimension of tensors to `n_bins` and stack them along a new leading channel dimension'''
+    return torch.stack([torch.cat((f, f.new_zeros(f.shape[:-1]+(n_bins-f.shape[-1],))), -1) for f in fs])
+
+class MultiChannel():
+    r'''Binned likelihood combining several channels, e.g. signal and control regions, which share the POI and nuisances.
+    Templates of each channel are normalised to unity and channels can have different numbers of bins: nominal templates are passed as a tensor (n_channels, n_bins),
+    or a list of (n_bins) tensors, and up/down shape variations as a tensor (n_channels, n_shape_alphas, n_bins), or a list of (n_shape_alphas, n_bins) tensors,
+    with `None`s for channels unaffected by the shape nuisances, whose number is also set by the length of `shape_aux`. Templates are zero-padded to a common number of bins, and padded bins are masked,
+    so that the NLL of all channels is evaluated in single vectorised operations.
+    `s_true` and `b_true` are the expected signal and background yields of each channel. The POI scales the signal yields of all channels, and equals `mu_true`,
+    by default the total signal yield, at nominal. `s_norm` and `b_norm` are the changes in the yield of each channel per unit of each normalisation nuisance,
+    with shape (n_norm_alphas, n_channels); by default, yields change in proportion to the nominal yields, such that total yields change by one unit.
+    Constraints are as per `calc_batch_nll`, and observed counts per channel and bin can be passed via `obs`, otherwise the Asimov dataset is used.
+    As per `TemplateModel`, interpolation coefficients and the data are precomputed once.
+    Nuisances are ordered as shape, signal-norm, and background-norm nuisances.'''
+    def __init__(self, f_s_nom:Union[Tensor,List[Tensor]], f_b_nom:Union[Tensor,List[Tensor]], s_true:Union[Tensor,List[float]], b_true:Union[Tensor,List[float]],
+                 f_s_up:Optional[Union[Tensor,List[Optional[Tensor]]]]=None, f_s_dw:Optional[Union[Tensor,List[Optional[Tensor]]]]=None,
+                 f_b_up:Optional[Union[Tensor,List[Optional[Tensor]]]]=None, f_b_dw:Optional[Union[Tensor,List[Optional[Tensor]]]]=None,
+                 mu_true:Optional[float]=None, s_norm:Optional[Tensor]=None, b_norm:Optional[Tensor]=None, shape_aux:Optional[List[Distribution]]=None,
+                 s_norm_aux:Optional[List[Distribution]]=None, b_norm_aux:Optional[List[Distribution]]=None, nonaux_b_norm:bool=False,
+                 obs:Optional[Union[Tensor,List[Tensor]]]=None):
+        self.templates = {k:[None]*len(f_s_nom) if f is None else list(f) for k,f in
+                          (('f_s_nom',f_s_nom), ('f_b_nom',f_b_nom), ('f_s_up',f_s_up), ('f_s_dw',f_s_dw), ('f_b_up',f_b_up), ('f_b_dw',f_b_dw))}
+        self.shape_aux,self.nonaux_b_norm = shape_aux,nonaux_b_norm
+        self.s_norm_aux = [] if s_norm_aux is None else s_norm_aux
+        self.b_norm_aux = [] if b_norm_aux is None else b_norm_aux
+        ref = self.templates['f_s_nom'][0]
+        self.n_channels,self.n_bins = len(f_s_nom),[f.shape[-1] for f in self.templates['f_s_nom']]
+        n = max(self.n_bins)
+        self.mask = torch.arange(n, device=ref.device)[None] < torch.tensor(self.n_bins, device=ref.device)[:,None]
+        self.f_s_nom,self.f_b_nom = _pad_bins(self.templates['f_s_nom'], n),_pad_bins(self.templates['f_b_nom'], n)
+        self.obs = None if obs is None else _pad_bins(list(obs), n)
+        # Shape variations, flattened over channels and bins to shape (n_shape_alphas, n_channels*n_bins), and their interpolation coefficients
+        n_shapes = {len(f) for k,fs in self.templates.items() if k[-2:] in ('up','dw') for f in fs if f is not None}
+        if shape_aux is not None: n_shapes.add(len(shape_aux))
+        if len(n_shapes) > 1: raise ValueError("All channels must have the same number of shape variations, matching the number of auxiliary measurements on shape nuisances.\
+                                                Pass `None` for channels, or auxiliary measurements, unaffected by shape nuisances.")
+        self.n_shape_alphas = n_shapes.pop() if len(n_shapes) else 0
+        self.f_s_up = self.f_s_dw = self.f_b_up = self.f_b_dw = None
+        if self.n_shape_alphas > 0:
+            for k in ('f_s_up','f_s_dw','f_b_up','f_b_dw'):
+                fs = [f_nom.expand(self.n_shape_alphas,-1) if f is None else f for f,f_nom in zip(self.templates[k], self.templates[k[:4]+'nom'])]
+                setattr(self, k, _pad_bins(fs, n).transpose(0,1).reshape(self.n_shape_alphas,-1))
+            self.s_coefs = _interp_coefs(self.f_s_nom.flatten(), self.f_s_up, self.f_s_dw)
+            self.b_coefs = _interp_coefs(self.f_b_nom.flatten(), self.f_b_up, self.f_b_dw)
+        # Yields
+        self.s_true,self.b_true = torch.as_tensor(s_true, dtype=ref.dtype, device=ref.device),torch.as_tensor(b_true, dtype=ref.dtype, device=ref.device)
+        self.mu_true = self.s_true.sum().item() if mu_true is None else mu_true
+        n_s,n_b = len(self.s_norm_aux),len(self.b_norm_aux)+nonaux_b_norm
+        self.s_norm = (self.s_true/self.mu_true)[None].repeat(n_s,1) if s_norm is None else torch.as_tensor(s_norm, dtype=ref.dtype, device=ref.device)
+        self.b_norm = (self.b_true/self.b_true.sum())[None].repeat(n_b,1) if b_norm is None else torch.as_tensor(b_norm, dtype=ref.dtype, device=ref.device)
+        if self.s_norm.shape != (n_s,self.n_channels) or self.b_norm.shape != (n_b,self.n_channels):
+            raise ValueError("Shapes of `s_norm` and `b_norm` must be (number of normalisation nuisances, number of channels)")
+        self.shape_idxs = list(range(self.n_shape_alphas))
+        self.s_norm_idxs = list(range(self.n_shape_alphas, self.n_shape_alphas+n_s))
+        self.b_norm_idxs = list(range(self.n_shape_alphas+n_s, self.n_shape_alphas+n_s+n_b))
+        self.n_alpha = self.n_shape_alphas+n_s+n_b
+        self.data = (self.s_true[:,None]*self.f_s_nom)+(self.b_true[:,None]*self.f_b_nom) if self.obs is None else self.obs
+        self.log_norm = torch.lgamma(self.data+1)
+
+    def with_channel(self, f_s_nom:Tensor, f_b_nom:Tensor, s_true:float, b_true:float, f_s_up:Optional[Tensor]=None, f_s_dw:Optional[Tensor]=None,
+                     f_b_up:Optional[Tensor]=None, f_b_dw:Optional[Tensor]=None) -> 'MultiChannel':
+        r'''Return a copy of the likelihood with a further channel prepended, e.g. the shapes of a network, whose signal yield is the POI,
+        and whose yields change by one unit per unit of each normalisation nuisance, as per `calc_batch_nll`'''
+        if self.obs is not None: raise ValueError("Channels can only be added to likelihoods of the Asimov dataset")
+        new = dict(f_s_nom=f_s_nom, f_b_nom=f_b_nom, f_s_up=f_s_up, f_s_dw=f_s_dw, f_b_up=f_b_up, f_b_dw=f_b_dw)
+        return MultiChannel(**{k:[new[k]]+fs for k,fs in self.templates.items()}, mu_true=s_true,
+                            s_true=torch.cat((self.s_true.new_tensor([s_true]), self.s_true)), b_true=torch.cat((self.b_true.new_tensor([b_true]), self.b_true)),
+                            s_norm=torch.cat((torch.ones_like(self.s_norm[:,:1]), self.s_norm), 1), b_norm=torch.cat((torch.ones_like(self.b_norm[:,:1]), self.b_norm), 1),
+                            shape_aux=self.shape_aux, s_norm_aux=self.s_norm_aux, b_norm_aux=self.b_norm_aux, nonaux_b_norm=self.nonaux_b_norm)
+
+    def nll(self, mu:Tensor, alpha:Tensor) -> Tensor:
+        r'''Compute negative log-likelihoods for a batch of parameter points, `mu` with shape (n_points) and `alpha` with shape (n_points, n_alpha)'''
+        shape_alpha,s_norm_alpha,b_norm_alpha = alpha[:,self.shape_idxs],alpha[:,self.s_norm_idxs],alpha[:,self.b_norm_idxs]
+        #  Adjust expectation by nuisances
+        f_s,f_b = self.f_s_nom,self.f_b_nom
+        if self.n_shape_alphas > 0:
+            f_s = f_s+_interp_var(shape_alpha, *self.s_coefs).view(-1, *f_s.shape)
+            f_b = f_b+_interp_var(shape_alpha, *self.b_coefs).view(-1, *f_b.shape)
+        s_exp = (mu[:,None]*self.s_true/self.mu_true)+(s_norm_alpha@self.s_norm)
+        b_exp = self.b_true                          +(b_norm_alpha@self.b_norm)
+        #  Compute NLL over unpadded bins of all channels
+        t_exp = ((s_exp[...,None]*f_s)+(b_exp[...,None]*f_b)).masked_fill(~self.mask, 1)  # Padded bins kept finite
+        nll = (t_exp-torch.xlogy(self.data, t_exp)+self.log_norm).masked_fill(~self.mask, 0).sum((-1,-2))  # Poisson
+        # Constrain nuisances
+        for i,x in enumerate([] if self.shape_aux is None else self.shape_aux):
+            if x is not None: nll = nll-x.log_prob(shape_alpha[:,i])
+        for i,x in enumerate(self.s_norm_aux): nll = nll-x.log_prob(s_norm_alpha[:,i])
+        for i,x in enumerate(self.b_norm_aux): nll = nll-x.log_prob(b_norm_alpha[:,i])
+        return nll
+
+    def profile(self, mu_scan:Tensor, n_steps:int=100, lr:float=0.1, tol:float=1e-5, solver:Optional[NewtonSolver]=None, verbose:bool=True) -> Tensor:
+        r'''Compute profile likelihoods for range of mu values, optimising all nuisances in parallel, as per `calc_profile`'''
+        mu_scan = mu_scan.to(self.f_s_nom.device)
+        alpha = torch.zeros((len(mu_scan),self.n_alpha), dtype=self.f_s_nom.dtype, device=self.f_s_nom.device)
+        if self.n_alpha > 0:
+            if solver is None: solver = NewtonSolver(n_steps=n_steps, lr=lr, step_tol=tol)
+            alpha = solver(lambda a: calc_batch_grad_hesse(self.nll(mu_scan, a), a), alpha, nll=lambda a: self.nll(mu_scan, a), verbose=verbose)
+        with torch.no_grad(): return self.nll(mu_scan, alpha)
+
+# Cell
+def sample_toys(f_s_nom:Tensor, f_b_nom:Tensor, mu_true:float, b_true:float, toy_idxs:Union[int,Iterable[int]], seed:int=0) -> Tensor:
+    r'''Poisson-sample observed counts per bin for toy experiments at the true parameter values, returning a tensor of shape (n_toys, n_bins).
+    Each toy is drawn from its own generator seeded with `seed` plus its index, so results do not depend on how toys are batched or split across processes.'''
+    if isinstance(toy_idxs, int): toy_idxs = range(toy_idxs)
+    rate = ((mu_true*f_s_nom)+(b_true*f_b_nom)).detach().reshape(-1).cpu()
+    toys = [torch.poisson(rate, generator=torch.Generator().manual_seed(seed+i)) for i in toy_idxs]
+    return torch.stack(toys).to(f_b_nom.device)
+
+# Cell
+def fit_toys(obs:Tensor, f_s_nom:Tensor, f_b_nom:Tensor, b_true:float, mu_init:float,
+             f_s_up:Optional[Tensor]=None, f_s_dw:Optional[Tensor]=None,
+             f_b_up:Optional[Tensor]=None, f_b_dw:Optional[Tensor]=None,
+             shape_aux:Optional[List[Distribution]]=None,
+             s_norm_aux:Optional[List[Distribution]]=None, b_norm_aux:Optional[List[Distribution]]=None, nonaux_b_norm:bool=False,
+             n_steps:int=100, lr:float=0.1, tol:float=1e-5, solver:Optional[NewtonSolver]=None, verbose:bool=False) -> Dict[str,np.ndarray]:
+    r'''Fit mu and nuisances to a batch of observed datasets `obs` (n_toys, n_bins) simultaneously via Newton's method on closed-form hessians.
+    Returns a dictionary of the fitted `mu`, the `width` of the likelihood in mu from the inverse hessian at the minimum, the fitted nuisances `alpha`,
+    and the nuisance `pulls`: fitted nuisances relative to the mean and standard deviation of their auxiliary measurements (unconstrained nuisances are unscaled).
+    Fits which fail to converge are returned as NaN. A configured `NewtonSolver` can be passed via `solver`, in which case `n_steps`, `lr`, and `tol` are ignored.'''
+    templates,(shape_idxs,s_norm_idxs,b_norm_idxs) = _get_nuisances(f_s_nom=f_s_nom, f_b_nom=f_b_nom, f_s_up=f_s_up, f_s_dw=f_s_dw, f_b_up=f_b_up, f_b_dw=f_b_dw,
+                                                                     s_norm_aux=s_norm_aux, b_norm_aux=b_norm_aux, nonaux_b_norm=nonaux_b_norm)
+    n_alpha = len(shape_idxs)+len(s_norm_idxs)+len(b_norm_idxs)
+    nll_kwargs = dict(s_true=mu_init, b_true=b_true, obs=obs, shape_aux=shape_aux, **templates)
+    get_nll = partialler(calc_batch_nll, **nll_kwargs)
+    get_grad_hesse = partialler(calc_analytic_grad_hesse, **nll_kwargs)
+
+    def _grad_hesse(theta:Tensor) -> Tuple[Tensor,Tensor]:
+        _, grad, hesse = get_grad_hesse(mu=theta[:,0], shape_alpha=theta[:,1:][:,shape_idxs],
+                                        s_norm_alpha=theta[:,1:][:,s_norm_idxs], b_norm_alpha=theta[:,1:][:,b_norm_idxs])
+        return grad, hesse
+
+    def _nll(theta:Tensor) -> Tensor:
+        return get_nll(mu=theta[:,0], shape_alpha=theta[:,1:][:,shape_idxs], s_norm_alpha=theta[:,1:][:,s_norm_idxs], b_norm_alpha=theta[:,1:][:,b_norm_idxs])
+
+    theta = obs.new_zeros((len(obs),1+n_alpha))
+    theta[:,0] = mu_init
+    if solver is None: solver = NewtonSolver(n_steps=n_steps, lr=lr, step_tol=tol)
+    theta = solver(_grad_hesse, theta, nll=_nll, verbose=verbose).detach()
+    width = calc_poi_var(_grad_hesse(theta)[1]).sqrt()
+    fail = torch.isnan(theta).any(1)|torch.isnan(width)
+    theta[fail], width[fail] = math.nan, math.nan
+
+    alpha = theta[:,1:]
+    aux = (shape_aux if shape_aux is not None else [None]*len(shape_idxs))+templates['s_norm_aux']+templates['b_norm_aux']
+    pulls = alpha.clone()
+    for i,x in enumerate(aux):
+        if x is not None: pulls[:,i] = (alpha[:,i]-x.mean)/x.stddev
+    return {'mu':to_np(theta[:,0]), 'width':to_np(width), 'alpha':to_np(alpha), 'pulls':to_np(pulls)}
+
+# Cell
+def _run_toys_chunk(toy_idxs:List[int], sample_kwargs:Dict[str,Any], fit_kwargs:Dict[str,Any]) -> Dict[str,np.ndarray]:
+    r'''Sample and fit a chunk of toys. Defined at module level so that it can be sent to worker processes.'''
+    return fit_toys(obs=sample_toys(toy_idxs=toy_idxs, **sample_kwargs), **fit_kwargs)
+
+# Cell
+def run_toys(n_toys:int, f_s_nom:Tensor, f_b_nom:Tensor, n_obs:int, mu_true:float,
+             f_s_up:Optional[Tensor]=None, f_s_dw:Optional[Tensor]=None,
+             f_b_up:Optional[Tensor]=None, f_b_dw:Optional[Tensor]=None,
+             shape_aux:Optional[List[Distribution]]=None,
+             s_norm_aux:Optional[List[Distribution]]=None, b_norm_aux:Optional[List[Distribution]]=None, nonaux_b_norm:bool=False,
+             n_steps:int=100, lr:float=0.1, tol:float=1e-5, seed:int=0, chunk_size:int=1000, n_workers:int=1) -> Dict[str,np.ndarray]:
+    r'''Run `n_toys` pseudo-experiments: sample observed counts from the nominal templates at the true parameter values and fit each for mu and the nuisances.
+    Template arguments are as for `calc_profile`, e.g. `run_toys(n_toys, f_s_nom=f_s, n_obs=1050, mu_true=50, **get_paper_syst_shapes(...))`.
+    Toys are fitted in batches of `chunk_size`, optionally distributed over `n_workers` processes (templates are then moved to CPU).
+    Toy `i` is always sampled with seed `seed+i`, so results are independent of `chunk_size` and `n_workers`.
+    Returns a dictionary of arrays of the fitted `mu`, the `width` of the likelihood in mu, the fitted nuisances `alpha`, and the nuisance `pulls`; see `fit_toys`.'''
+    if n_workers > 1:
+        f_s_nom,f_b_nom,f_s_up,f_s_dw,f_b_up,f_b_dw = [f.detach().cpu() if f is not None else f for f in [f_s_nom,f_b_nom,f_s_up,f_s_dw,f_b_up,f_b_dw]]
+    else:
+        f_s_nom,f_b_nom,f_s_up,f_s_dw,f_b_up,f_b_dw = [f.detach() if f is not None else f for f in [f_s_nom,f_b_nom,f_s_up,f_s_dw,f_b_up,f_b_dw]]
     b_true = n_obs-mu_true
-    if n_alpha > 0:
-        nlls = []
-        get_nll = partialler(calc_nll, s_true=mu_true, b_true=b_true,
-                         f_s_nom=f_s_nom, f_s_up=f_s_up, f_s_dw=f_s_dw,
-                         f_b_nom=f_b_nom, f_b_up=f_b_up, f_b_dw=f_b_dw,
-                         s_norm_aux=s_norm_aux, b_norm_aux=b_norm_aux, shape_aux=shape_aux)
-        for mu in progress_bar(mu_scan, display=verbose):  # TODO: Fix this to run mu-scan in parallel
-                alpha = torch.zeros((n_alpha), requires_grad=True, device=f_b_nom.device)
-                for i in range(n_steps):  # Newton optimise nuisances
-                    nll = get_nll(shape_alpha=alpha[shape_idxs], mu=mu, s_norm_alpha=alpha[s_norm_idxs], b_norm_alpha=alpha[b_norm_idxs])
-                    grad, hesse = calc_grad_hesse(nll, alpha, create_graph=False)
-                    step = lr*grad.detach()@torch.inverse(hesse)
-                    step = torch.clamp(step, -100, 100)
-                    alpha = alpha-step
-                nlls.append(get_nll(shape_alpha=alpha[shape_idxs], mu=mu, s_norm_alpha=alpha[s_norm_idxs], b_norm_alpha=alpha[b_norm_idxs]).detach())
-                if alpha[shape_idxs].abs().max() > 1: print(f'Linear regime: Mu {mu.data.item()}, shape nuisances {alpha[shape_idxs].data}')
-        nlls = torch.stack(nlls)
+    sample_kwargs = dict(f_s_nom=f_s_nom, f_b_nom=f_b_nom, mu_true=mu_true, b_true=b_true, seed=seed)
+    fit_kwargs = dict(f_s_nom=f_s_nom, f_b_nom=f_b_nom, b_true=b_true, mu_init=mu_true, f_s_up=f_s_up, f_s_dw=f_s_dw, f_b_up=f_b_up, f_b_dw=f_b_dw,
+                      shape_aux=shape_aux, s_norm_aux=s_norm_aux, b_norm_aux=b_norm_aux, nonaux_b_norm=nonaux_b_norm, n_steps=n_steps, lr=lr, tol=tol)
+    chunks = [list(range(i, min(i+chunk_size, n_toys))) for i in range(0, n_toys, chunk_size)]
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers, initializer=torch.set_num_threads, initargs=(1,)) as pool:
+            results = list(pool.map(_run_toys_chunk, chunks, itertools.repeat(sample_kwargs), itertools.repeat(fit_kwargs)))
     else:
-        nlls = -torch.distributions.Poisson((mu_scan.reshape((-1,1))*f_s_nom)+(b_true*f_b_nom), False).log_prob((mu_true*f_s_nom)+(b_true*f_b_nom)).sum(1)
-    return nlls
\ No newline at end of file
+        results = [_run_toys_chunk(c, sample_kwargs, fit_kwargs) for c in progress_bar(chunks, display=len(chunks) > 1)]
+    return {k:np.concatenate([r[k] for r in results]) for k in results[0]}
\ No newline at end of file
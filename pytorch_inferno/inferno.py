@@ -3,8 +3,9 @@
 __all__ = ['VariableSoftmax', 'AbsInferno', 'PaperInferno', 'InfernoPred', 'AbsApproxInferno', 'ApproxPaperInferno']
 
 # Cell
-from .callback import AbsCallback, PredHandler
-from .inference import calc_grad_hesse
+from .callback import AbsCallback, PredHandler, paper_nuisances
+from .inference import calc_grad_hesse, calc_poi_var, histogram, _aux_grad_hesse
+from .distributed import all_reduce_sum, all_reduce_grad
 
 import numpy as np
 from abc import abstractmethod, ABCMeta
@@ -26,9 +27,17 @@ class VariableSoftmax(nn.Softmax):
 
 # Cell
 class AbsInferno(AbsCallback, metaclass=ABCMeta):
-    r'''Attempted reproduction of TF1 & TF2 INFERNO with exact effect of nuisances being passed through model'''
+    r'''Attempted reproduction of TF1 & TF2 INFERNO with exact effect of nuisances being passed through model.
+    If `reuse_nominal` is true, the forwards pass of the nominal batch provides the shapes without derivatives w.r.t. nuisances, and only inputs affected by nuisances
+    are passed through the model again, rather than passing the nominal inputs again. Since fewer inputs then carry derivatives w.r.t. nuisances, computing the hessian is cheaper.
+    Other callbacks then see the nominal inputs and predictions.
+    Inheriting classes declare the effect of shape nuisances on the inputs as a `NuisanceTransform` of the full parameter vector, `transform`, which is applied out-of-place
+    to the inputs affected by shape nuisances, or override `_aug_data`.
+    Passes through the model run in the precision of the wrapper, e.g. under mixed precision if `amp_dtype` is passed to `ModelWrapper.fit`.
+    If `loss_dtype` is set, e.g. `torch.float64`, predictions are promoted to it and the shapes, NLL, and hessian are computed in that precision.'''
     def __init__(self, b_true:float, mu_true:float, n_shape_alphas:int=0, s_shape_alpha:bool=False, b_shape_alpha:bool=False, nonaux_b_norm:bool=False,
-                 shape_aux:Optional[List[Distribution]]=None, b_norm_aux:Optional[List[Distribution]]=None, s_norm_aux:Optional[List[Distribution]]=None):
+                 shape_aux:Optional[List[Distribution]]=None, b_norm_aux:Optional[List[Distribution]]=None, s_norm_aux:Optional[List[Distribution]]=None,
+                 hesse_method:str='loop', reuse_nominal:bool=False, loss_dtype:Optional[torch.dtype]=None):
         store_attr()
         if self.shape_aux is not None and len(self.shape_aux) != self.n_shape_alphas: raise ValueError("Number of auxillary measurements on shape nuisances must match the number of shape nuisance parameters")
         self.n=self.mu_true+self.b_true
@@ -48,58 +57,80 @@ class AbsInferno(AbsCallback, metaclass=ABCMeta):
         self.wrapper.loss_func = None  # Ensure loss function is skipped, callback computes loss value in `on_forwards_end`
         for c in self.wrapper.cbs:
             if hasattr(c, 'loss_is_meaned'): c.loss_is_meaned = False  # Ensure that average losses are correct
-        self.alpha = torch.zeros((self.n_alpha), requires_grad=True, device=self.wrapper.device)  # Nuisances set to zero (true values)
+        self.alpha = torch.zeros((self.n_alpha), requires_grad=True, device=self.wrapper.device, dtype=self.loss_dtype)  # Nuisances set to zero (true values)
         with torch.no_grad(): self.alpha[self.poi_idx] = self.mu_true  # POI set to true value
 
     def on_batch_begin(self) -> None:
         self.b_mask = self.wrapper.y.squeeze() == 0
-        self._aug_data(self.wrapper.x)
+        if not self.reuse_nominal: self.wrapper.x = self._aug_data(self.wrapper.x)
 
     def on_batch_end(self) -> None:
         self.alpha.grad.data.zero_()
 
-    @abstractmethod
     def _aug_data(self, x:Tensor) -> Tensor:
-        r'''Include nuisances in input data. Overide this for specific problem.'''
-        pass
+        r'''Return copy of input data including nuisances, by applying `transform` to the signal and/or background inputs, as per `s_shape_alpha` and `b_shape_alpha`'''
+        if not (self.s_shape_alpha or self.b_shape_alpha): return x
+        mask = None if self.s_shape_alpha and self.b_shape_alpha else ~self.b_mask if self.s_shape_alpha else self.b_mask
+        return self.transform(x, all_reduce_grad(self.alpha), mask=mask)  # Derivatives of shapes summed over processes if distributed
 
     def get_inv_ikk(self, f_s:Tensor, f_b:Tensor, f_s_asimov:Tensor, f_b_asimov:Tensor) -> Tensor:
-        r'''Compute full hessian at true param values'''
+        r'''Compute variance of the POI from the hessian at true param values.
+        The Poisson term depends on normalisation nuisances only via the total signal and background yields, so its hessian is only computed for the POI, shape nuisances,
+        and one background normalisation, i.e. the number of backward passes does not grow with the number of normalisation nuisances.
+        Auxiliary measurements only add diagonal terms, and the POI variance is computed via `calc_poi_var`, rather than by inverting the hessian.'''
         # Compute nll
         s_exp = self.alpha[self.poi_idx]+self.alpha[self.s_norm_idxs].sum() if len(self.s_norm_idxs) > 0 else self.alpha[self.poi_idx]
         b_exp = self.b_true             +self.alpha[self.b_norm_idxs].sum() if len(self.b_norm_idxs) > 0 else self.b_true
         t_exp  = (s_exp*f_s)+(b_exp*f_b)
         asimov = (self.mu_true*f_s_asimov)+(self.b_true*f_b_asimov)
         nll = -torch.distributions.Poisson(t_exp, False).log_prob(asimov).sum()
+        # Parameters affecting the same yield share rows of the hessian of the Poisson term
+        rows = list(range(self.n_alpha))
+        for i in self.s_norm_idxs: rows[i] = self.poi_idx[0]
+        for i in self.b_norm_idxs: rows[i] = self.b_norm_idxs[0]
+        uniq = sorted(set(rows))
+        _,h = calc_grad_hesse(nll, self.alpha, create_graph=True, method=self.hesse_method, idxs=uniq)
+        h = h[[uniq.index(r) for r in rows]]
         # Constrain nll
-        if self.shape_aux is not None:
-            for a,x in zip(self.alpha[self.shape_idxs], self.shape_aux):
-                if x is not None: nll = nll-x.log_prob(a)
-        if len(self.b_norm_idxs):
-            for i,x in zip(self.b_norm_idxs, self.b_norm_aux): nll = nll-x.log_prob(self.alpha[i])
-        if len(self.s_norm_idxs):
-            for i,x in zip(self.s_norm_idxs, self.s_norm_aux): nll = nll-x.log_prob(self.alpha[i])
-        _,h = calc_grad_hesse(nll, self.alpha, create_graph=True)
-        return torch.inverse(h)[self.poi_idx,self.poi_idx]
+        d = torch.zeros_like(self.alpha)  # Diagonal hessian of auxiliary measurements
+        for idxs,x in ((self.shape_idxs,self.shape_aux), (self.s_norm_idxs,self.s_norm_aux), (self.b_norm_idxs,self.b_norm_aux)):
+            if x is not None and len(x) > 0: d[idxs[:len(x)]] = _aux_grad_hesse(self.alpha[None,idxs[:len(x)]], x)[2][0]  # Non-auxiliary norms come last
+        return calc_poi_var(h+torch.diag(d), self.poi_idx[0])
+
+    def _predict(self, x:Tensor) -> Tensor:
+        r'''Pass inputs through the model in the same precision as the wrapper's forwards pass, returning predictions in `loss_dtype`, if set'''
+        with self.wrapper.autocast(): p = self.wrapper.model(x)
+        if self.loss_dtype is not None: return p.to(self.loss_dtype)
+        return p if self.wrapper.amp_dtype is None else p.float()
 
     @staticmethod
     def to_shape(p:Tensor, w:Optional[Tensor]=None) -> Tensor:
-        f = (p*w).sum(0)+1e-7 if w is not None else p.sum(0)+1e-7
-        return f/f.sum()
+        return histogram(p, w=w, reduce=all_reduce_sum)  # Sum over processes if distributed
 
     def on_forwards_end(self) -> None:
         r'''Compute loss and replace wrapper loss value'''
 
         w_s = self.wrapper.w[~self.b_mask] if self.wrapper.w is not None else None
         w_b = self.wrapper.w[self.b_mask] if self.wrapper.w is not None else None
-
-        # Shapes with derivatives w.r.t. nuisances
-        f_s = self.to_shape(self.wrapper.y_pred[~self.b_mask], w_s)
-        f_b = self.to_shape(self.wrapper.y_pred[self.b_mask], w_b)
-
-        # Shapes without derivatives w.r.t. nuisances
-        f_s_asimov = self.to_shape(self.wrapper.model(self.wrapper.x[~self.b_mask].detach()), w_s) if self.s_shape_alpha else f_s
-        f_b_asimov = self.to_shape(self.wrapper.model(self.wrapper.x[self.b_mask].detach()), w_b)  if self.b_shape_alpha else f_b
+        y_pred = self.wrapper.y_pred if self.loss_dtype is None else self.wrapper.y_pred.to(self.loss_dtype)
+
+        if self.reuse_nominal:
+            # Shapes without derivatives w.r.t. nuisances
+            f_s_asimov = self.to_shape(y_pred[~self.b_mask], w_s)
+            f_b_asimov = self.to_shape(y_pred[self.b_mask], w_b)
+
+            # Shapes with derivatives w.r.t. nuisances, only affected inputs are passed through the model again
+            x = self._aug_data(self.wrapper.x)
+            f_s = self.to_shape(self._predict(x[~self.b_mask]), w_s) if self.s_shape_alpha else f_s_asimov
+            f_b = self.to_shape(self._predict(x[self.b_mask]), w_b)  if self.b_shape_alpha else f_b_asimov
+        else:
+            # Shapes with derivatives w.r.t. nuisances
+            f_s = self.to_shape(y_pred[~self.b_mask], w_s)
+            f_b = self.to_shape(y_pred[self.b_mask], w_b)
+
+            # Shapes without derivatives w.r.t. nuisances
+            f_s_asimov = self.to_shape(self._predict(self.wrapper.x[~self.b_mask].detach()), w_s) if self.s_shape_alpha else f_s
+            f_b_asimov = self.to_shape(self._predict(self.wrapper.x[self.b_mask].detach()), w_b)  if self.b_shape_alpha else f_b
 
         self.wrapper.loss_val = self.get_inv_ikk(f_s=f_s, f_b=f_b, f_s_asimov=f_s_asimov, f_b_asimov=f_b_asimov)
 
@@ -110,10 +141,8 @@ class PaperInferno(AbsInferno):
     def __init__(self, float_r:bool, float_l:bool, l_init:float=3, b_true:float=1000, mu_true:float=50, **kwargs):
         super().__init__(b_true=b_true, mu_true=mu_true, n_shape_alphas=float_r+float_l, b_shape_alpha=True, **kwargs)
         self.float_r,self.float_l,self.l_init = float_r,float_l,l_init
-
-    def _aug_data(self, x:Tensor) -> None:
-        if self.float_r: x[self.b_mask,0] += self.alpha[self.shape_idxs[0]]
-        if self.float_l: x[self.b_mask,2] *= (self.alpha[self.shape_idxs[-1]]+self.l_init)/self.l_init
+        self.transform = paper_nuisances(r_idx=self.shape_idxs[0] if float_r else None, l_idx=self.shape_idxs[-1] if float_l else None,
+                                         n_alpha=self.n_alpha, l_init=l_init)
 
 # Cell
 class InfernoPred(PredHandler):
@@ -121,21 +150,36 @@ class InfernoPred(PredHandler):
     def get_preds(self) -> np.ndarray: return np.argmax(self.preds, 1)
 
 # Cell
-from .inference import calc_nll
+from .inference import calc_nll, calc_analytic_grad_hesse, NewtonSolver, MultiChannel, TemplateModel
 
 from fastcore.all import partialler
-from typing import Tuple
+from typing import Tuple, Union
+import warnings
 
 # Cell
 class AbsApproxInferno(AbsInferno, metaclass=ABCMeta):
     r'''Attempted reproduction INFERNO following paper description implementations with nuisances being approximated by creating up/down shapes and interpolating
-    Includes option to randomise params per batch and converge to better values, which results in slightly better performance'''
+    Includes option to randomise params per batch and converge to better values, which results in slightly better performance.
+    Params are converged via a `NewtonSolver`, by default running `n_steps` steps, or via `solver` if passed, e.g. to warm-start from the previous batch's optimum and stop once converged.
+    The number of Newton iterations run for each batch is recorded in `n_iters`.
+    If `compile_loss` is true, the loss is computed from closed-form hessians by a function compiled via `torch.compile`,
+    falling back to eager computation if compilation is unavailable or fails.
+    Further fixed channels, e.g. control regions, can be passed as a `MultiChannel` via `channels`, in which case the loss is computed from the combined likelihood
+    of the shapes of the model and `channels`, using the nuisances and auxiliary measurements of `channels`, whose nuisances and `mu_true` must match those of the callback.
+    Otherwise, unless hessians are computed in closed form, the likelihood of each batch is built once as a `TemplateModel`, and reused by all Newton steps.
+    Inheriting classes declare `transform` as for `AbsInferno`, and the nuisance settings of the up/down variations of each shape nuisance for signal and/or background,
+    shape (up/down, n_shape_alphas, n_alpha), as `s_alpha` and `b_alpha`, or override `_get_up_down`.'''
     @delegates(AbsInferno)
-    def __init__(self, aug_alpha:bool=False, n_steps:int=100, lr:float=0.1, **kwargs):
+    def __init__(self, aug_alpha:bool=False, n_steps:int=100, lr:float=0.1, analytic:bool=False, solver:Optional[NewtonSolver]=None,
+                 compile_loss:bool=False, channels:Optional[MultiChannel]=None, **kwargs):
         super().__init__(**kwargs)
-        store_attr('aug_alpha, n_steps, lr')
+        store_attr('aug_alpha, n_steps, lr, analytic, compile_loss, channels')
+        if channels is not None and (analytic or compile_loss): raise ValueError("Closed-form hessians are not supported for multiple channels")
+        if channels is not None and (channels.n_alpha != self.n_alpha-1 or channels.mu_true != self.mu_true):
+            raise ValueError("Channels must have the same nuisances and `mu_true` as the callback")
+        self.solver = NewtonSolver(n_steps=n_steps, lr=lr, step_tol=0) if solver is None else solver
+        self.inv_ikk_func,self.s_alpha,self.b_alpha = None,None,None
 
-    def _aug_data(self): pass  # Override abs method
     def on_batch_begin(self) -> None: pass
     def on_batch_end(self) -> None: pass
 
@@ -143,37 +187,82 @@ class AbsApproxInferno(AbsInferno, metaclass=ABCMeta):
         self.wrapper.loss_func = None  # Ensure loss function is skipped, callback computes loss value in `on_forwards_end`
         for c in self.wrapper.cbs:
             if hasattr(c, 'loss_is_meaned'): c.loss_is_meaned = False  # Ensure that average losses are correct
+        self.solver.reset()
+        self.n_iters = []
 
-    @abstractmethod
     def _get_up_down(self, x_s:Tensor, x_b:Tensor, w_s:Optional[Tensor]=None, w_b:Optional[Tensor]=None) -> Tuple[Tuple[Optional[Tensor],Optional[Tensor]],Tuple[Optional[Tensor],Optional[Tensor]]]:
-        r'''Compute upd/down shapes for signal and background seperately. Overide this for specific problem.'''
-        pass
+        r'''Compute up/down shapes for signal and background seperately, by applying `transform` at the settings in `s_alpha` and `b_alpha`, if set.
+        Overide this for problems whose variations cannot be expressed via `transform`.'''
+        def _up_down(x:Tensor, w:Optional[Tensor], alpha:Optional[Tensor]) -> Tuple[Optional[Tensor],Optional[Tensor]]:
+            if alpha is None or self.n_shape_alphas == 0: return None,None
+            f = self._get_shapes(self.transform(x, alpha.flatten(0,1).to(x.device)), w).view(2, self.n_shape_alphas, -1)
+            return f[0],f[1]
+        return _up_down(x_s, w_s, self.s_alpha),_up_down(x_b, w_b, self.b_alpha)
+
+    def _get_shapes(self, x:Tensor, w:Optional[Tensor]=None) -> Tensor:
+        r'''Pass a stack of variations of inputs, shape (n_variations, n_events, n_features), through the model in a single call and return their shapes, shape (n_variations, n_bins)'''
+        return self.to_shape(self._predict(x.reshape(-1, x.shape[-1])).view(x.shape[0], x.shape[1], -1), w)
+
+    def _calc_grad_hesse(self, alpha:Tensor, create_graph:bool=False, **kwargs) -> Tuple[Tensor,Tensor]:
+        r'''Compute gradient and hessian of nll w.r.t. alpha, either in closed form or via autograd'''
+        if self.analytic:
+            _,g,h = calc_analytic_grad_hesse(mu=alpha[self.poi_idx], shape_alpha=alpha[None,self.shape_idxs],
+                                             s_norm_alpha=alpha[None,self.s_norm_idxs], b_norm_alpha=alpha[None,self.b_norm_idxs], **kwargs)
+            return g[0],h[0]
+        return calc_grad_hesse(self._calc_nll(alpha, **kwargs), alpha, create_graph=create_graph, method=self.hesse_method)
+
+    def _calc_nll(self, alpha:Tensor, likelihood:Optional[Union[TemplateModel,MultiChannel]]=None, **kwargs) -> Tensor:
+        if likelihood is not None: return likelihood.nll(alpha[None,self.poi_idx[0]], alpha[None,1:])[0]
+        return calc_nll(mu=alpha[self.poi_idx], s_norm_alpha=alpha[self.s_norm_idxs], b_norm_alpha=alpha[self.b_norm_idxs], shape_alpha=alpha[self.shape_idxs], **kwargs)
 
     def get_ikk(self, f_s_nom:Tensor, f_b_nom:Tensor, f_s_up:Optional[Tensor], f_s_dw:Optional[Tensor], f_b_up:Optional[Tensor], f_b_dw:Optional[Tensor]) -> Tensor:
         r'''Compute full hessian at true param values, or at random starting values with Newton updates'''
-        if self.aug_alpha: alpha = torch.randn((self.n_alpha), requires_grad=True, device=self.wrapper.device)/10
-        else:              alpha = torch.zeros((self.n_alpha), requires_grad=True, device=self.wrapper.device)
+        if self.aug_alpha: alpha = torch.randn((self.n_alpha), requires_grad=True, device=self.wrapper.device, dtype=f_s_nom.dtype)/10
+        else:              alpha = torch.zeros((self.n_alpha), requires_grad=True, device=self.wrapper.device, dtype=f_s_nom.dtype)
         with torch.no_grad(): alpha[self.poi_idx] += self.mu_true
-        get_nll = partialler(calc_nll, s_true=self.mu_true, b_true=self.b_true,
-                             f_s_nom=f_s_nom, f_b_nom=f_b_nom, f_s_up=f_s_up, f_s_dw=f_s_dw,
-                             f_b_up=f_b_up, f_b_dw=f_b_dw, shape_aux=self.shape_aux, s_norm_aux=self.s_norm_aux, b_norm_aux=self.b_norm_aux)
+        kwargs = dict(s_true=self.mu_true, b_true=self.b_true, f_s_nom=f_s_nom, f_b_nom=f_b_nom, f_s_up=f_s_up, f_s_dw=f_s_dw,
+                      f_b_up=f_b_up, f_b_dw=f_b_dw, shape_aux=self.shape_aux, s_norm_aux=self.s_norm_aux, b_norm_aux=self.b_norm_aux)
+        if self.channels is not None:  # Combine shapes of the model with the further channels
+            kwargs = dict(likelihood=self.channels.with_channel(f_s_nom=f_s_nom, f_b_nom=f_b_nom, s_true=self.mu_true, b_true=self.b_true,
+                                                                f_s_up=f_s_up, f_s_dw=f_s_dw, f_b_up=f_b_up, f_b_dw=f_b_dw))
+        elif not (self.analytic or self.compile_loss):  # Precompute interpolation coefficients once for all evaluations of the NLL
+            kwargs = dict(likelihood=TemplateModel(**kwargs, nonaux_b_norm=self.nonaux_b_norm))
+        get_grad_hesse = partialler(self._calc_grad_hesse, **kwargs)
         if self.aug_alpha:  # Alphas carry noise, optimise via Newton
-            for i in range(self.n_steps):  # Newton optimise nuisances & mu
-                nll = get_nll(mu=alpha[self.poi_idx], s_norm_alpha=alpha[self.s_norm_idxs], b_norm_alpha=alpha[self.b_norm_idxs], shape_alpha=alpha[self.shape_idxs])
-                g,h = calc_grad_hesse(nll, alpha)
-                s = torch.clamp(self.lr*g.detach()@torch.inverse(h), -100, 100)
-                alpha = alpha-s
-        nll = get_nll(mu=alpha[self.poi_idx], s_norm_alpha=alpha[self.s_norm_idxs], b_norm_alpha=alpha[self.b_norm_idxs], shape_alpha=alpha[self.shape_idxs])
-        _,h = calc_grad_hesse(nll, alpha, create_graph=True)
-        return torch.inverse(h)[self.poi_idx,self.poi_idx]
+            alpha = self.solver(lambda a: tuple(t[None] for t in get_grad_hesse(a[0])), alpha[None],
+                                nll=lambda a: self._calc_nll(a[0], **kwargs)[None])[0]  # Newton optimise nuisances & mu
+            self.n_iters.append(self.solver.n_iters[0].item())
+        if self.compile_loss: return self._compiled_inv_ikk(alpha, **kwargs)
+        _,h = get_grad_hesse(alpha, create_graph=True)
+        return calc_poi_var(h, self.poi_idx[0])
+
+    def _calc_inv_ikk(self, alpha:Tensor, **kwargs) -> Tensor:
+        _,_,h = calc_analytic_grad_hesse(mu=alpha[self.poi_idx], shape_alpha=alpha[None,self.shape_idxs],
+                                         s_norm_alpha=alpha[None,self.s_norm_idxs], b_norm_alpha=alpha[None,self.b_norm_idxs], **kwargs)
+        return calc_poi_var(h[0], self.poi_idx[0])
+
+    def _compiled_inv_ikk(self, alpha:Tensor, **kwargs) -> Tensor:
+        if self.inv_ikk_func is None:
+            if hasattr(torch, 'compile'):
+                self.inv_ikk_func = torch.compile(self._calc_inv_ikk, dynamic=False)
+            else:
+                warnings.warn("torch.compile is unavailable, INFERNO loss will be computed in eager mode")
+                self.inv_ikk_func = self._calc_inv_ikk
+        try:
+            return self.inv_ikk_func(alpha, **kwargs)
+        except Exception as e:
+            warnings.warn(f"Compilation of INFERNO loss failed, falling back to eager mode: {e}")
+            self.inv_ikk_func = self._calc_inv_ikk
+            return self.inv_ikk_func(alpha, **kwargs)
 
     def on_forwards_end(self) -> None:
         r'''Compute loss and replace wrapper loss value'''
         b = self.wrapper.y.squeeze() == 0
         w_s = self.wrapper.w[~b] if self.wrapper.w is not None else None
         w_b = self.wrapper.w[b] if self.wrapper.w is not None else None
-        f_s = self.to_shape(self.wrapper.y_pred[~b], w_s)
-        f_b = self.to_shape(self.wrapper.y_pred[b], w_b)
+        y_pred = self.wrapper.y_pred if self.loss_dtype is None else self.wrapper.y_pred.to(self.loss_dtype)
+        f_s = self.to_shape(y_pred[~b], w_s)
+        f_b = self.to_shape(y_pred[b], w_b)
         (f_s_up,f_s_dw),(f_b_up,f_b_dw)= self._get_up_down(self.wrapper.x[~b], self.wrapper.x[b])
         self.wrapper.loss_val = self.get_ikk(f_s_nom=f_s, f_b_nom=f_b, f_s_up=f_s_up, f_s_dw=f_s_dw, f_b_up=f_b_up, f_b_dw=f_b_dw)
 
@@ -185,31 +274,9 @@ class ApproxPaperInferno(AbsApproxInferno):
                  b_true:float=1000, mu_true:float=50, **kwargs):
         super().__init__(b_true=b_true, mu_true=mu_true, n_shape_alphas=(r_mods is not None)+(l_mods is not None), b_shape_alpha=True, **kwargs)
         store_attr('r_mods, l_mods, l_init')
-
-    def on_train_begin(self) -> None:
-        super().on_train_begin()
-        if self.r_mods is not None:
-            self.r_mod_t = (torch.zeros(1,3, device=self.wrapper.device),torch.zeros(1,3, device=self.wrapper.device))
-            self.r_mod_t[0][0,0] = self.r_mods[0]
-            self.r_mod_t[1][0,0] = self.r_mods[1]
-        if self.l_mods is not None:
-            self.l_mod_t = (torch.ones(1,3, device=self.wrapper.device),torch.ones(1,3, device=self.wrapper.device))
-            self.l_mod_t[0][0,2] = self.l_mods[0]/self.l_init
-            self.l_mod_t[1][0,2] = self.l_mods[1]/self.l_init
-
-    def _get_up_down(self, x_s:Tensor, x_b:Tensor, **kwargs) -> Tuple[Tuple[Optional[Tensor],Optional[Tensor]],Tuple[Optional[Tensor],Optional[Tensor]]]:
-        if self.r_mods is None and self.l_mods is None: return (None,None),(None,None)
-        u,d = [],[]
-        if self.r_mods is not None:
-            with torch.no_grad(): x_b = x_b+self.r_mod_t[0]
-            d.append(self.to_shape(self.wrapper.model(x_b)))
-            with torch.no_grad(): x_b = x_b+self.r_mod_t[1]-self.r_mod_t[0]
-            u.append(self.to_shape(self.wrapper.model(x_b)))
-            with torch.no_grad(): x_b = x_b-self.r_mod_t[1]
-        if self.l_mods is not None:
-            with torch.no_grad(): x_b = x_b*self.l_mod_t[0]
-            d.append(self.to_shape(self.wrapper.model(x_b)))
-            with torch.no_grad(): x_b = x_b*self.l_mod_t[1]/self.l_mod_t[0]
-            u.append(self.to_shape(self.wrapper.model(x_b)))
-            with torch.no_grad(): x_b = x_b/self.l_mod_t[1]
-        return (None,None),(torch.stack(u),torch.stack(d))
\ No newline at end of file
+        self.transform = paper_nuisances(r_idx=None if r_mods is None else self.shape_idxs[0], l_idx=None if l_mods is None else self.shape_idxs[-1],
+                                         n_alpha=self.n_alpha, l_init=l_init)
+        # Parameter settings of up/down variations of each shape nuisance, shape (up/down, n_shape_alphas, n_alpha)
+        self.b_alpha = torch.zeros(2, self.n_shape_alphas, self.n_alpha)
+        if r_mods is not None: self.b_alpha[:,0,self.shape_idxs[0]] = torch.tensor(r_mods[::-1])
+        if l_mods is not None: self.b_alpha[:,-1,self.shape_idxs[-1]] = torch.tensor(l_mods[::-1])-l_init
\ No newline at end of file
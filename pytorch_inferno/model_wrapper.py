@@ -4,29 +4,50 @@ __all__ = ['ModelWrapper']
 
 # Cell
 from .callback import AbsCallback, PredHandler
-from .utils import to_device, device
-from .data import DataPair, WeightedDataLoader, DataSet
+from .utils import to_device, device, fingerprint, PredCache, get_pred_cache
+from .data import DataPair, WeightedDataLoader, DataSet, TensorDataSet, BatchDataLoader, Prefetcher
 
-from typing import Optional, Union, List, Generator, Callable
+from typing import Optional, Union, List, Generator, Callable, Iterable, Iterator
 from fastcore.all import store_attr, is_listy, typedispatch, Path
 from fastprogress import master_bar, progress_bar
 import numpy as np
+import time
+from contextlib import suppress
 
 from torch import Tensor
 import torch
 import torch.nn as nn
 from torch import optim
 
+# Cell
+def _autocast(device_type:str, dtype:torch.dtype):
+    r'''Mixed-precision context via `torch.autocast`, falling back to `torch.cuda.amp.autocast` for PyTorch < 1.10, which only supports float16 on CUDA'''
+    if hasattr(torch, 'autocast'): return torch.autocast(device_type, dtype=dtype)
+    if device_type != 'cuda' or dtype != torch.float16: raise ValueError("PyTorch < 1.10 only supports mixed precision in float16 on CUDA devices")
+    return torch.cuda.amp.autocast()
+
+def _grad_scaler(device_type:str):
+    r'''Loss scaler via `torch.amp.GradScaler`, falling back to `torch.cuda.amp.GradScaler` for PyTorch < 2.3'''
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'): return torch.amp.GradScaler(device_type)
+    return torch.cuda.amp.GradScaler(enabled=device_type == 'cuda')
+
 # Cell
 class ModelWrapper():
     r'''Class to handle training and prediction of NN over data, with optional callbacks. Also supports loading and saving.'''
     def __init__(self, model:nn.Module, device:torch.device=device):
         self.model,self.device = to_device(model, device),device
+        self.amp_dtype,self.scaler = None,None
+
+    def autocast(self):
+        r'''Context for passing inputs through the model during training, which runs in `amp_dtype` precision via `torch.autocast`, if set'''
+        if self.amp_dtype is None or self.state == 'test': return suppress()  # No-op context; nullcontext requires Python >= 3.7
+        return _autocast(torch.device(self.device).type, self.amp_dtype)
 
     def _fit_batch(self, x:Tensor, y:Tensor, w:Tensor) -> None:
         self.x,self.y,self.w = to_device(x,self.device),to_device(y,self.device),to_device(w,self.device)
         for c in self.cbs: c.on_batch_begin()
-        self.y_pred = self.model(self.x)
+        with self.autocast(): self.y_pred = self.model(self.x)
+        if self.amp_dtype is not None: self.y_pred = self.y_pred.float()  # Losses and callbacks receive full-precision predictions
         if self.state != 'test' and self.loss_func is not None:
             self.loss_func.weights = self.w
             self.loss_val = self.loss_func(self.y_pred, self.y)
@@ -35,30 +56,56 @@ class ModelWrapper():
 
         self.opt.zero_grad()
         for c in self.cbs: c.on_backwards_begin()
-        self.loss_val.backward()
+        if self.scaler is None: self.loss_val.backward()
+        else:
+            self.scaler.scale(self.loss_val).backward()
+            self.scaler.unscale_(self.opt)  # Callbacks see true gradients
         for c in self.cbs: c.on_backwards_end()
-        self.opt.step()
+        if self.scaler is None: self.opt.step()
+        else:
+            self.scaler.step(self.opt)
+            self.scaler.update()
         for c in self.cbs: c.on_batch_end()
 
+    def _fit_batches(self, dl:Iterable) -> None:
+        it = iter(progress_bar(dl, parent=self.mb))
+        while True:
+            t0 = time.perf_counter()
+            b = next(it, None)
+            t1 = time.perf_counter()
+            self.timings['data'] += t1-t0
+            if b is None: break
+            self._fit_batch(*b)
+            self.timings['compute'] += time.perf_counter()-t1
+
     def fit(self, n_epochs:int, data:DataPair, opt:Callable[[Generator],optim.Optimizer],
-            loss:Optional[Callable[[Tensor,Tensor],Tensor]], cbs:Optional[Union[AbsCallback,List[AbsCallback]]]=None) -> None:
+            loss:Optional[Callable[[Tensor,Tensor],Tensor]], cbs:Optional[Union[AbsCallback,List[AbsCallback]]]=None, prefetch:bool=False,
+            amp_dtype:Optional[torch.dtype]=None) -> None:
+        r'''Train the model for `n_epochs` on `data`. If `prefetch` is true, batches are prepared in the background via `Prefetcher`.
+        If `amp_dtype` is set, e.g. `torch.bfloat16`, forwards passes run in mixed precision via `torch.autocast` and predictions are returned to float32;
+        losses are then scaled via `GradScaler` for `torch.float16`. Callbacks may compute losses at higher precision, e.g. via the `loss_dtype` of INFERNO callbacks.
+        Time spent waiting for data and computing is recorded in `timings`, see `print_timings`.'''
         def fit_epoch(epoch:int) -> None:
             self.model.train()
             self.state = 'train'
             self.epoch = epoch
             for c in self.cbs: c.on_epoch_begin()
-            for b in progress_bar(self.data.trn_dl, parent=self.mb): self._fit_batch(*b)
+            self._fit_batches(self.data.trn_dl)
             for c in self.cbs: c.on_epoch_end()
 
             self.model.eval()
             self.state = 'valid'
             for c in self.cbs: c.on_epoch_begin()
-            for b in progress_bar(self.data.val_dl, parent=self.mb): self._fit_batch(*b)
+            self._fit_batches(self.data.val_dl)
             for c in self.cbs: c.on_epoch_end()
 
         if cbs is None: cbs = []
         elif not is_listy(cbs): cbs = [cbs]
+        if prefetch: data = DataPair(Prefetcher(data.trn_dl, device=self.device), Prefetcher(data.val_dl, device=self.device))
         self.cbs,self.stop,self.n_epochs = cbs,False,n_epochs
+        self.timings = {'data':0., 'compute':0.}
+        self.amp_dtype = amp_dtype
+        self.scaler = _grad_scaler(torch.device(self.device).type) if amp_dtype == torch.float16 else None
         self.data,self.loss_func,self.opt = data,loss,opt(self.model.parameters())
         for c in self.cbs: c.set_wrapper(self)
         for c in self.cbs: c.on_train_begin()
@@ -68,28 +115,62 @@ class ModelWrapper():
             if self.stop: break
         for c in self.cbs: c.on_train_end()
 
-    def _predict_dl(self, x:WeightedDataLoader, pred_cb:PredHandler=PredHandler(),
-                cbs:Optional[Union[AbsCallback,List[AbsCallback]]]=None) -> np.ndarray:
+    def print_timings(self) -> None:
+        r'''Print time spent waiting for data and computing during the last call to `fit`.
+        N.B. computation on CUDA devices is asynchronous, so compute times only include time until the device is next synchronised.'''
+        tot = sum(self.timings.values())
+        for k,v in self.timings.items(): print(f'{k.capitalize()}: {v:.2f}s ({100*v/tot:.1f}%)')
+
+    def _set_pred(self, x:Iterable, pred_cb:PredHandler, cbs:Optional[Union[AbsCallback,List[AbsCallback]]]) -> None:
         if cbs is None: cbs = []
         elif not is_listy(cbs): cbs = [cbs]
-        cbs.append(pred_cb)
-        self.cbs,self.data = cbs,x
+        self.cbs,self.data = [*cbs,pred_cb],x
         self.state = 'test'
         for c in self.cbs: c.set_wrapper(self)
         self.model.eval()
-        for c in self.cbs: c.on_pred_begin()
-        for b in progress_bar(self.data): self._fit_batch(*b)
-        for c in self.cbs: c.on_pred_end()
+
+    def _predict_batches(self, batches:Iterable) -> None:
+        with torch.inference_mode() if hasattr(torch, 'inference_mode') else torch.no_grad():  # inference_mode requires PyTorch >= 1.9
+            for c in self.cbs: c.on_pred_begin()
+            for b in batches: self._fit_batch(*b)
+            for c in self.cbs: c.on_pred_end()
+
+    def _predict_dl(self, x:WeightedDataLoader, pred_cb:PredHandler=PredHandler(),
+                cbs:Optional[Union[AbsCallback,List[AbsCallback]]]=None) -> np.ndarray:
+        self._set_pred(x, pred_cb, cbs)
+        self._predict_batches(progress_bar(self.data))
         return pred_cb.get_preds()
 
     def _predict_array(self, x:Union[Tensor,np.ndarray], pred_cb:PredHandler=PredHandler(),
-                   cbs:Optional[Union[AbsCallback,List[AbsCallback]]]=None) -> np.ndarray:
-        return self._predict_dl(WeightedDataLoader(DataSet(x), batch_size=len(x)), pred_cb, cbs)
+                   cbs:Optional[Union[AbsCallback,List[AbsCallback]]]=None, bs:Optional[int]=None) -> np.ndarray:
+        return self._predict_dl(BatchDataLoader(TensorDataSet(x), batch_size=len(x) if bs is None else bs), pred_cb, cbs)
 
     def predict(self, x:Union[Tensor,np.ndarray], pred_cb:PredHandler=PredHandler(),
-                cbs:Optional[Union[AbsCallback,List[AbsCallback]]]=None) -> np.ndarray:
-        if isinstance(x, WeightedDataLoader): return self._predict_dl(x, pred_cb, cbs)
-        else:                                 return self._predict_array(x, pred_cb, cbs)
+                cbs:Optional[Union[AbsCallback,List[AbsCallback]]]=None, cache:Optional[PredCache]=None, bs:Optional[int]=100000) -> np.ndarray:
+        r'''Predict on `x`, either a `WeightedDataLoader` or an array of inputs, which is passed through the model in chunks of `bs` inputs (all at once if `bs` is `None`).
+        Predictions are written into a single array, which can be preallocated, or memory-mapped, by passing it as the `out` argument of `pred_cb`.
+        Predictions are cached in `cache`, or the default cache set via `set_pred_cache`, keyed by the model, the inputs, `pred_cb`, and `cbs`, so unchanged predictions are loaded rather than recomputed.'''
+        if cache is None: cache = get_pred_cache()
+        if cache is not None:
+            key = fingerprint('predict', self.model, x.dataset.x if isinstance(x, WeightedDataLoader) else x, pred_cb, cbs)
+            res = cache.get(key)
+            if res is not None:  # Collected predictions are cached, so that they are also written into `out` of `pred_cb`, if set
+                pred_cb.set_preds(res['preds'])
+                return pred_cb.get_preds()
+        if isinstance(x, WeightedDataLoader): preds = self._predict_dl(x, pred_cb, cbs)
+        else:                                 preds = self._predict_array(x, pred_cb, cbs, bs=bs)
+        if cache is not None: cache.set(key, {'preds':pred_cb.preds})
+        return preds
+
+    def predict_chunks(self, x:Union[Tensor,np.ndarray,WeightedDataLoader], bs:int=100000, pred_cb:PredHandler=PredHandler(),
+                       cbs:Optional[Union[AbsCallback,List[AbsCallback]]]=None) -> Iterator[np.ndarray]:
+        r'''Generator yielding predictions on `x` chunk by chunk, each processed by `pred_cb`, such that only one chunk of predictions is held in memory at a time.
+        Chunks are batches of `x`, if it is a `WeightedDataLoader`, otherwise `bs` inputs.'''
+        dl = x if isinstance(x, WeightedDataLoader) else BatchDataLoader(TensorDataSet(x), batch_size=bs)
+        for b in dl:
+            self._set_pred([b], pred_cb, cbs)  # Data of unknown size, so buffers are not allocated for the whole dataset
+            self._predict_batches(self.data)
+            yield pred_cb.get_preds()
 
     def save(self, fname:Union[Path,str]) -> None: torch.save({'model':self.model.state_dict()}, fname)
 
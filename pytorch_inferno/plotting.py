@@ -4,7 +4,7 @@ __all__ = ['plt_style', 'plt_sz', 'plt_cat_pal', 'plt_tk_sz', 'plt_lbl_sz', 'plt
            'plot_likelihood']
 
 # Cell
-from .inference import get_likelihood_width
+from .inference import get_likelihood_widths
 
 import pandas as pd
 import numpy as np
@@ -13,6 +13,7 @@ import seaborn as sns
 from typing import Optional, Union, List, Dict
 import numpy as np
 
+import torch
 from torch import Tensor
 
 from fastcore.all import is_listy
@@ -60,16 +61,14 @@ def plot_likelihood(nlls:Union[Dict[str,Tensor],List[Tensor]], mu_scan:Tensor, l
     if labels is None: labels = ['' for _ in nlls]
     elif not is_listy(labels): labels = [labels]
 
-    widths = []
+    widths = get_likelihood_widths(torch.stack([torch.as_tensor(nll) for nll in nlls]), mu_scan).tolist()  # NaN if width cannot be computed
     with sns.axes_style(**plt_style), sns.color_palette(plt_cat_pal):
         plt.figure(figsize=(plt_sz*16/9, plt_sz))
         plt.plot(mu_scan,0.5*np.ones_like(mu_scan), linestyle='--', color='black')
-        for nll,lbl in zip(nlls,labels):
+        for nll,lbl,width in zip(nlls,labels,widths):
             m = nll == nll
             dnll = nll-nll[m].min()  # Shift nll to zero
-            try:               widths.append(get_likelihood_width(nll, mu_scan=mu_scan))
-            except ValueError: widths.append(np.NaN)
-            plt.plot(mu_scan[m], dnll[m], label=fr'{lbl} $\mu={mu_scan[np.argmin(nll[m])]}\pm {widths[-1]:.2f}$')
+            plt.plot(mu_scan[m], dnll[m], label=fr'{lbl} $\mu={mu_scan[np.argmin(nll[m])]}\pm {width:.2f}$')
         plt.legend(fontsize=plt_leg_sz)
         plt.xlabel(r"$\mu$", fontsize=plt_lbl_sz)
         plt.ylabel(r"Profiled $\Delta\left(-L\right)$", fontsize=plt_lbl_sz)
@@ -1,13 +1,18 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/00_pseudodata.ipynb (unless otherwise specified).
 
-__all__ = ['PseudoData', 'paper_sig', 'paper_bkg']
+__all__ = ['PseudoData', 'TorchPseudoData', 'paper_sig', 'paper_bkg']
 
 # Cell
+from .utils import device
+
 from fastcore.all import store_attr
-from typing import Callable, Tuple, Union, List
+from typing import Callable, Tuple, Union, List, Optional
 import numpy as np
 import pandas as pd
 
+import torch
+from torch import Tensor
+
 # Cell
 class PseudoData():
     r'''Generic class for constructing pseudodata via sampling of random functions'''
@@ -22,6 +27,25 @@ class PseudoData():
         df.rename(columns={df.columns[-1]:'gen_target'}, inplace=True)
         return df
 
+# Cell
+class TorchPseudoData(PseudoData):
+    r'''Generic class for constructing pseudodata via sampling of random functions directly on `device`.
+    `func` should take the number of events, and `generator`, `device`, and `dtype` keyword arguments, e.g. `_PaperData.sample_torch`'''
+    def __init__(self, func:Callable[[int],Tensor], targ:Union[float,int], device:torch.device=device, dtype:torch.dtype=torch.float32):
+        super().__init__(func, targ)
+        store_attr('device,dtype')
+
+    def __getitem__(self, i:int) -> Tuple[Tensor,Tensor,None]: return self.sample(1)
+    def sample(self, n:int, generator:Optional[torch.Generator]=None) -> Tuple[Tensor,Tensor,None]:
+        return (self.func(n, generator=generator, device=self.device, dtype=self.dtype),
+                torch.full((n,1), self.targ, dtype=self.dtype, device=self.device),None)
+
+    def get_df(self, n:int) -> pd.DataFrame:
+        x,y,_ = self.sample(n)
+        df = pd.DataFrame(torch.cat((x,y), 1).cpu().numpy())
+        df.rename(columns={df.columns[-1]:'gen_target'}, inplace=True)
+        return df
+
 # Cell
 class _PaperData():
     r'''Callable class generating pseudodata from Inferno paper'''
@@ -29,11 +53,23 @@ class _PaperData():
         store_attr(but=['mu', 'r'])
         self.r = np.array([r,0])
         self.mu = np.array(mu)
+        self._torch_params = {}  # Mean and Cholesky factor of covariance per device and dtype, for `sample_torch`
 
     def sample(self, n:int) -> np.ndarray:
         return np.hstack((np.random.multivariate_normal(self.mu+self.r, self.conv, n),
                           np.random.exponential(1/self.l, size=n)[:,None]))
 
+    def sample_torch(self, n:int, generator:Optional[torch.Generator]=None, device:torch.device=torch.device('cpu'),
+                     dtype:torch.dtype=torch.float32) -> Tensor:
+        r'''Sample directly on `device` via PyTorch using the Cholesky decomposition of the covariance matrix, rather than via Numpy'''
+        key = (str(torch.device(device)),dtype)
+        if key not in self._torch_params:
+            self._torch_params[key] = (torch.tensor(self.mu+self.r, dtype=dtype, device=device),
+                                       torch.linalg.cholesky(torch.tensor(self.conv, dtype=dtype, device=device)))
+        mu,tril = self._torch_params[key]
+        x = torch.randn((n,len(mu)), generator=generator, dtype=dtype, device=device)
+        return torch.cat((mu+(x@tril.T), torch.empty((n,1), dtype=dtype, device=device).exponential_(self.l, generator=generator)), 1)
+
     def __call__(self, n:int) -> np.ndarray: return self.sample(n)
 
 # Cell
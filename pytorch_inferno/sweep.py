@@ -0,0 +1,152 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: nbs/10_sweep.ipynb (unless otherwise specified).
+
+__all__ = ['param_grid', 'SweepStore', 'train_paper_inferno', 'run_sweep']
+
+# Cell
+from .model_wrapper import ModelWrapper
+from .data import DataPair, WeightedDataLoader
+from .callback import LossTracker, EarlyStopping
+from .inferno import PaperInferno, ApproxPaperInferno, VariableSoftmax
+from .inference import histogram, get_paper_syst_shapes, calc_profile, get_likelihood_widths
+from .utils import init_net, to_np
+
+import numpy as np
+import pandas as pd
+from typing import Optional, Callable, List, Dict, Any, Iterable, Union
+from fastcore.all import is_listy, partialler
+from fastprogress import progress_bar
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import itertools
+import hashlib
+import json
+import os
+import shutil
+import warnings
+from pathlib import Path
+
+import torch
+from torch import Tensor, nn, optim
+
+# Cell
+def param_grid(**params:Any) -> List[Dict[str,Any]]:
+    r'''Configurations for every combination of the listed values of `params`; non-list values are common to all configurations,
+    e.g. `param_grid(float_r=[True,False], lr=[1e-3,1e-4], seed=range(3))`'''
+    keys = list(params)
+    vals = [list(v) if is_listy(v) or isinstance(v, range) else [v] for v in params.values()]
+    return [dict(zip(keys, v)) for v in itertools.product(*vals)]
+
+# Cell
+class SweepStore():
+    r'''Directory of sweep results, holding a subdirectory per configuration named by a hash of the configuration.
+    Each contains the configuration (`config.json`), the weights (`weights.h5`, loadable via `ModelWrapper.load`), and the remaining results (`results.json`).
+    Subdirectories are written to a temporary location and then renamed, so a configuration is either complete or absent, even if a sweep is interrupted.
+    Configurations should be JSON-serialisable; other values are stored and hashed via their string representations.'''
+    def __init__(self, path:Union[str,Path]):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def config_id(config:Dict[str,Any]) -> str: return hashlib.md5(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    def __contains__(self, config:Dict[str,Any]) -> bool: return (self.path/self.config_id(config)).exists()
+    def __len__(self) -> int: return len(self.ids())
+    def ids(self) -> List[str]: return sorted(p.name for p in self.path.iterdir() if p.is_dir() and not p.name.startswith('.'))
+
+    def save(self, config:Dict[str,Any], results:Dict[str,Any]) -> None:
+        r'''Save `results` of `config`; a `state_dict` entry is saved as weights, and all other entries must be JSON-serialisable'''
+        results = dict(results)
+        cid = self.config_id(config)
+        tmp = self.path/f'.{cid}.tmp'
+        if tmp.exists(): shutil.rmtree(tmp)
+        tmp.mkdir()
+        if 'state_dict' in results: torch.save({'model':results.pop('state_dict')}, tmp/'weights.h5')
+        with open(tmp/'config.json', 'w') as fout: json.dump(config, fout, default=str)
+        with open(tmp/'results.json', 'w') as fout: json.dump(results, fout)
+        if (self.path/cid).exists(): shutil.rmtree(self.path/cid)
+        os.replace(tmp, self.path/cid)
+
+    def load(self, config:Union[str,Dict[str,Any]]) -> Dict[str,Any]:
+        r'''Load results of `config`, or of the configuration with id `config`, including the configuration itself'''
+        d = self.path/(config if isinstance(config, str) else self.config_id(config))
+        with open(d/'results.json') as fin: res = json.load(fin)
+        with open(d/'config.json') as fin: res['config'] = json.load(fin)
+        return res
+
+    def weights_path(self, config:Union[str,Dict[str,Any]]) -> Path:
+        return self.path/(config if isinstance(config, str) else self.config_id(config))/'weights.h5'
+
+    def to_df(self) -> pd.DataFrame:
+        r'''Summary of all stored configurations: a row per configuration, indexed by id, with columns for the configuration and scalar results'''
+        rows = []
+        for cid in self.ids():
+            res = self.load(cid)
+            rows.append({'id':cid, **res.pop('config'), **{k:v for k,v in res.items() if np.isscalar(v)}})
+        return pd.DataFrame(rows).set_index('id') if len(rows) else pd.DataFrame()
+
+# Cell
+def train_paper_inferno(config:Dict[str,Any], data:DataPair, test:WeightedDataLoader, n_epochs:int, patience:Optional[int]=None, n_hidden:int=100,
+                        n_obs:int=1050, mu_true:float=50, mu_scan:Tensor=torch.linspace(20,80,61), profile_kwargs:Optional[Dict[str,Any]]=None) -> Dict[str,Any]:
+    r'''Train a network with an INFERNO loss on the paper problem according to `config`, and evaluate the width of its profile likelihood on `test` data.
+    `config` may set `seed` (default 0), the `lr` of Adam (default 1e-3), the softmax `temp` (default 0.1), whether the loss interpolates shapes (`interp`, default true),
+    and whether nuisances in the background shift (`float_r`) and rate (`float_l`) are included in the loss (default true).
+    All other entries are passed to `ApproxPaperInferno` or `PaperInferno`, e.g. `aug_alpha`. Training stops early after `patience` epochs without improvement, if set.
+    The width is computed via `calc_profile` for both background nuisances, with `profile_kwargs` passed on, e.g. `shape_aux`, and is NaN if it cannot be found.
+    Returns the `state_dict` of the trained network, the `losses` tracked by `LossTracker`, the `width`, and the profiled `nll` over `mu_scan`.'''
+    config = dict(config)
+    seed,lr,temp,interp = config.pop('seed', 0),config.pop('lr', 1e-3),config.pop('temp', 0.1),config.pop('interp', True)
+    float_r,float_l = config.pop('float_r', True),config.pop('float_l', True)
+    torch.manual_seed(seed)
+    net = nn.Sequential(nn.Linear(3,n_hidden),        nn.ReLU(),
+                        nn.Linear(n_hidden,n_hidden), nn.ReLU(),
+                        nn.Linear(n_hidden,10),       VariableSoftmax(temp))
+    init_net(net)
+    if interp: inferno = ApproxPaperInferno(r_mods=(-0.2,0.2) if float_r else None, l_mods=(2.5,3.5) if float_l else None, **config)
+    else:      inferno = PaperInferno(float_r=float_r, float_l=float_l, **config)
+    model,tracker = ModelWrapper(net),LossTracker()
+    model.fit(n_epochs, data=data, opt=partialler(optim.Adam, lr=lr), loss=None, cbs=[inferno,tracker]+([EarlyStopping(patience)] if patience else []))
+
+    preds,y = torch.as_tensor(model.predict(test)),torch.as_tensor(np.array(test.dataset.y)).squeeze()
+    b_shapes = get_paper_syst_shapes(np.array(test.dataset.x)[to_np(y == 0)], None, model=model)
+    nll = to_np(calc_profile(f_s_nom=histogram(preds[y == 1], mode='hard'), n_obs=n_obs, mu_scan=mu_scan, mu_true=mu_true, verbose=False,
+                             **b_shapes, **({} if profile_kwargs is None else profile_kwargs)))
+    width = get_likelihood_widths(nll, mu_scan).item()  # NaN if width cannot be computed
+    return {'state_dict':model.model.state_dict(), 'losses':tracker.losses, 'width':width, 'nll':nll.tolist()}
+
+# Cell
+_worker_kwargs = {}
+
+def _init_worker(n_threads:int, kwargs:Dict[str,Any]) -> None:
+    r'''Limit threads and receive arguments common to all configurations, e.g. data, once per worker process, rather than once per configuration'''
+    global _worker_kwargs
+    torch.set_num_threads(n_threads)
+    _worker_kwargs = kwargs
+
+def _run_config(train_func:Callable[...,Dict[str,Any]], config:Dict[str,Any]) -> Dict[str,Any]: return train_func(config, **_worker_kwargs)
+
+def run_sweep(configs:Iterable[Dict[str,Any]], store:Union[str,Path,SweepStore], train_func:Callable[...,Dict[str,Any]]=train_paper_inferno,
+              n_workers:int=1, n_threads:int=1, **kwargs) -> pd.DataFrame:
+    r'''Run `train_func(config, **kwargs)` for every configuration in `configs` which is not already in `store`, saving results as each configuration finishes.
+    Rerunning an interrupted sweep therefore only runs the missing configurations.
+    Configurations are run over `n_workers` processes, each limited to `n_threads` PyTorch threads; if `n_workers` > 1, `train_func` and `kwargs` must be picklable,
+    and `kwargs` are sent once per process, otherwise configurations run in the current process, whose thread limit is restored afterwards. Configurations which raise exceptions are warned about and not stored, so they will be rerun.
+    Returns `store.to_df()`.'''
+    if not isinstance(store, SweepStore): store = SweepStore(store)
+    todo = []
+    for c in configs:
+        if c not in store and c not in todo: todo.append(c)
+
+    def _save(config:Dict[str,Any], get_res:Callable[[],Dict[str,Any]]) -> None:
+        try:                   store.save(config, get_res())
+        except Exception as e: warnings.warn(f'Configuration {config} failed: {e!r}')
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(n_workers, initializer=_init_worker, initargs=(n_threads, kwargs)) as pool:
+            futures = {pool.submit(_run_config, train_func, c):c for c in todo}
+            for f in progress_bar(as_completed(futures), total=len(futures), display=len(futures) > 0):
+                _save(futures[f], f.result)
+    else:
+        n = torch.get_num_threads()
+        torch.set_num_threads(n_threads)
+        try:
+            for c in progress_bar(todo, display=len(todo) > 0): _save(c, lambda: train_func(c, **kwargs))
+        finally: torch.set_num_threads(n)
+    return store.to_df()
\ No newline at end of file
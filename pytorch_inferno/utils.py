@@ -1,6 +1,6 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/04_utils.ipynb (unless otherwise specified).
 
-__all__ = ['to_device', 'device', 'to_np', 'init_net']
+__all__ = ['to_device', 'device', 'to_np', 'init_net', 'fingerprint', 'PredCache', 'set_pred_cache', 'get_pred_cache']
 
 # Cell
 import torch
@@ -8,8 +8,14 @@ from torch import Tensor
 from torch.nn import init
 import torch.nn as nn
 
-from typing import Union, List
+from typing import Union, List, Any, Optional, Dict
 import numpy as np
+import hashlib
+import os
+import time
+import types
+from functools import partial
+from pathlib import Path
 
 # Cell
 device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
@@ -49,4 +55,126 @@ def init_net(model:nn.Module):
     if isinstance(model,nn.Linear):
         init.kaiming_normal_(model.weight, nonlinearity='relu')
         init.zeros_(model.bias)
-    for l in model.children(): init_net(l)
\ No newline at end of file
+    for l in model.children(): init_net(l)
+
+# Cell
+def _is_setting(x:Any) -> bool:
+    return x is None or isinstance(x, (bool,int,float,str,np.generic)) or (isinstance(x, (list,tuple)) and all(_is_setting(o) for o in x))
+
+def _update_hash(h:Any, x:Any, seen:Optional[set]=None) -> None:
+    seen = set() if seen is None else seen
+    if isinstance(x, Tensor): x = x.detach().cpu().numpy()
+    if isinstance(x, np.ndarray):
+        h.update(f'array{x.dtype}{x.shape}'.encode())
+        h.update(np.ascontiguousarray(x).data)
+    elif isinstance(x, nn.Module):
+        for m in x.modules(): _update_hash(h, (type(m).__qualname__, {k:v for k,v in vars(m).items() if k != 'training' and _is_setting(v)}), seen)
+        for k,v in x.state_dict().items(): _update_hash(h, (k,v), seen)
+    elif isinstance(x, dict):
+        h.update(b'{')
+        for k in sorted(x, key=str): _update_hash(h, (k,x[k]), seen)
+        h.update(b'}')
+    elif isinstance(x, (list,tuple)):
+        h.update(b'(')
+        for o in x: _update_hash(h, o, seen)
+        h.update(b')')
+    elif _is_setting(x) or isinstance(x, (torch.dtype,torch.device,bytes,complex)) or x is Ellipsis: h.update(repr(x).encode())
+    elif isinstance(x, (set,frozenset)): h.update(repr(sorted(repr(o) for o in x)).encode())
+    elif isinstance(x, types.CodeType):
+        h.update(x.co_code)
+        _update_hash(h, (x.co_names, x.co_consts), seen)  # Constants include code of nested functions
+    elif id(x) in seen: h.update(b'<cycle>')
+    elif isinstance(x, types.FunctionType):  # By code, defaults, and closure, so that e.g. lambdas and edited functions have different hashes
+        seen.add(id(x))
+        closure = []
+        for c in x.__closure__ or ():
+            try:               closure.append(c.cell_contents)
+            except ValueError: closure.append('<empty>')
+        _update_hash(h, (f'{x.__module__}.{x.__qualname__}', x.__code__, x.__defaults__, x.__kwdefaults__, closure), seen)
+        seen.discard(id(x))
+    elif isinstance(x, types.MethodType): _update_hash(h, (x.__func__, x.__self__), seen)
+    elif isinstance(x, partial): _update_hash(h, (x.func, x.args, x.keywords), seen)
+    elif hasattr(x, '__qualname__'): h.update(f'{getattr(x, "__module__", "")}.{x.__qualname__}'.encode())  # E.g. classes and builtins
+    elif hasattr(x, '__dict__'):  # Objects, e.g. callbacks, by class and attributes, excluding state declared in `_fingerprint_skip`, e.g. the wrapper
+        seen.add(id(x))
+        skip = getattr(x, '_fingerprint_skip', ())
+        _update_hash(h, (type(x).__qualname__, {k:v for k,v in vars(x).items() if k not in skip}), seen)
+        seen.discard(id(x))
+    else: raise TypeError(f'Cannot fingerprint object of type {type(x).__qualname__}')
+
+def fingerprint(*objs:Any) -> str:
+    r'''Content hash of `objs`: tensors and arrays by their data, modules by their parameters, buffers, and settings,
+    functions by their names, code, defaults, and closures (but not the globals they refer to), partials by their functions and arguments, classes and builtins by their names,
+    and other objects, e.g. callbacks, by their class and attributes, recursively, except for those named in the class attribute `_fingerprint_skip`.
+    Raises a `TypeError` for objects which cannot be inspected.'''
+    h = hashlib.blake2b(digest_size=16)
+    _update_hash(h, objs)
+    return h.hexdigest()
+
+# Cell
+class PredCache():
+    r'''On-disk cache of dictionaries of arrays, keyed by e.g. `fingerprint`s, with each entry saved as an `.npz` file.
+    Once the total size of the entries exceeds `max_size` bytes, the least recently used entries are evicted.'''
+    def __init__(self, path:Union[str,Path], max_size:int=2**30):
+        self.path,self.max_size = Path(path),max_size
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.hits,self.misses,self._last_used = 0,0,0
+
+    def _touch(self, fname:Path) -> None:
+        r'''Mark entry as most recently used; file times are set explicitly, since modification times may be too coarse to order quick accesses'''
+        self._last_used = max(int(time.time()*1e9), self._last_used+1)
+        os.utime(fname, ns=(self._last_used,self._last_used))
+
+    @staticmethod
+    def _unlink(fname:Path) -> None:
+        try:                      fname.unlink()
+        except FileNotFoundError: pass  # E.g. evicted by another process
+
+    def _fname(self, key:str) -> Path: return self.path/f'{key}.npz'
+    def _files(self) -> List[Path]: return [f for f in self.path.glob('*.npz') if not f.name.startswith('.')]
+    def __contains__(self, key:str) -> bool: return self._fname(key).exists()
+    def __len__(self) -> int: return len(self._files())
+    @property
+    def size(self) -> int: return sum(f.stat().st_size for f in self._files())
+
+    def get(self, key:str) -> Optional[Dict[str,np.ndarray]]:
+        r'''Load the entry for `key`, or return `None` if it is not cached'''
+        fname = self._fname(key)
+        try:
+            with np.load(fname) as data: res = {k:data[k] for k in data.files}
+            self._touch(fname)
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return res
+
+    def set(self, key:str, value:Dict[str,np.ndarray]) -> None:
+        r'''Save `value` as the entry for `key`, and evict least recently used entries if the cache is too large'''
+        tmp = self.path/f'.{key}.{os.getpid()}.npz'  # Write then rename, so that entries are never partially written
+        np.savez(tmp, **value)
+        os.replace(tmp, self._fname(key))
+        self._touch(self._fname(key))
+        self.evict()
+
+    def evict(self) -> None:
+        r'''Delete least recently used entries until the cache is no larger than `max_size`, always keeping the most recent entry'''
+        files = sorted(((f.stat().st_mtime_ns,f.stat().st_size,f) for f in self._files()), key=lambda o: o[0])
+        size = sum(o[1] for o in files)
+        for _,sz,f in files[:-1]:
+            if size <= self.max_size: break
+            self._unlink(f)
+            size -= sz
+
+    def clear(self) -> None:
+        for f in self._files(): self._unlink(f)
+
+# Cell
+_pred_cache = None
+
+def set_pred_cache(cache:Optional[PredCache]) -> None:
+    r'''Set the `PredCache` used by default by `ModelWrapper.predict` and `get_paper_syst_shapes`, or disable default caching with `None`'''
+    global _pred_cache
+    _pred_cache = cache
+
+def get_pred_cache() -> Optional[PredCache]: return _pred_cache
\ No newline at end of file